@@ -0,0 +1,312 @@
+import asyncio
+import instrument
+from cache import DnsCache
+from query import DnsQueryBuilder, new_query_id
+from response import DnsResponseBuilder
+from servers import QueryTimeout, ServerSelector
+from transport import frame, is_truncated, length_struct
+
+
+def with_id(packet, q_id):
+    return bytes((q_id >> 8, q_id & 255)) + packet[2:]
+
+
+class DnsError(Exception):
+    '''
+    Raised when the server answers with an error code,
+    rcode holds the code and the message is the one from error_check
+    '''
+
+    def __init__(self, rcode, message):
+        super().__init__(message)
+        self.rcode = rcode
+
+
+class AsyncQuery:
+    '''A query in flight, handle is the timer of its next retry'''
+    __slots__ = ('future', 'q_id', 'packet', 'handle', 'tries', 'started',
+                 'expires')
+
+    def __init__(self, future, packet, started, expires):
+        self.future = future
+        self.q_id = (packet[0] << 8) | packet[1]
+        self.packet = packet
+        self.handle = None
+        self.tries = 0
+        self.started = started
+        self.expires = expires
+
+
+class AsyncResolver(asyncio.DatagramProtocol):
+    '''
+    asyncio resolver multiplexing every query over one UDP transport.
+    The queries in flight are keyed by their query ID and each of them
+    has its own timer on the event loop, which sends the query again
+    with exponential backoff until its timeout runs out.
+    Truncated answers are asked again over one persistent TCP
+    connection, on which the queries are pipelined. With tcp set
+    every query goes over that connection.
+    Concurrent queries for the same name and type share one lookup,
+    and all of them get its result. Popular answers of a cache with
+    refresh set are asked again in the background before they expire.
+
+    Usage:
+        async with AsyncResolver('1.1.1.1') as resolver:
+            records = await resolver.query('google.com', 'A')
+    '''
+
+    def __init__(self, dns, port=53, timeout=5, recurse=True, cache=None,
+                 tcp=False, bufsize=1232):
+        self.selector = ServerSelector(dns, port)
+        self.server = self.selector.servers[0]
+        self.timeout = timeout
+        self.recurse = recurse
+        self.cache = cache
+        self.tcp = tcp
+        self.bufsize = bufsize
+        self.transport = None
+        self.pending = {}
+        self.inflight = {}
+        self.tcp_writer = None
+        self.tcp_lock = asyncio.Lock()
+        self.tcp_pending = {}
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(
+            lambda: self, remote_addr=self.server)
+        return self
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        if self.tcp_writer is not None:
+            self.tcp_writer.close()
+            self.tcp_writer = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        '''Every query still in flight fails with the transport'''
+        for entry in self.pending.values():
+            entry.handle.cancel()
+            if not entry.future.done():
+                entry.future.set_exception(
+                    exc or ConnectionError('Resolver was closed'))
+        self.pending.clear()
+
+    def error_received(self, exc):
+        # ICMP errors cannot be tied to a query, the timers handle them
+        pass
+
+    async def query(self, url, rtype='A'):
+        '''
+        Sends the query and waits for its answer.
+        Returns the records of the answer section, raises DnsError
+        for an error response and QueryTimeout if no answer arrives.
+        '''
+        if isinstance(rtype, str):
+            rtype = rtype.upper().encode('utf-8')
+
+        builder = DnsQueryBuilder(self.bufsize)
+        packet = builder.build_query_packet(url, rtype, self.recurse)
+        key = DnsCache.key(builder, packet)
+        if self.cache is not None:
+            data = self.cache.get(key, builder.q_id)
+            if data is not None:
+                if self.cache.refresh_due(key):
+                    self.refresh(url, rtype, key)
+                return self.decode(data, builder)
+
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.spawn(builder, packet, key)
+        # Shielded, so one caller being cancelled does not fail the others
+        return await asyncio.shield(task)
+
+    def spawn(self, builder, packet, key):
+        '''The task of a new lookup, that later queries for key share'''
+        task = asyncio.get_running_loop().create_task(
+            self.lookup(builder, packet, key))
+        self.inflight[key] = task
+        task.add_done_callback(lambda _: self.done(key, task))
+        return task
+
+    def refresh(self, url, rtype, key):
+        '''
+        Looks the cached answer up again in the background, queries
+        made in the meantime are still answered from the cache
+        '''
+        if key in self.inflight:
+            self.cache.refresh_done(key)
+            return
+        builder = DnsQueryBuilder(self.bufsize)
+        packet = builder.build_query_packet(url, rtype, self.recurse)
+        task = self.spawn(builder, packet, key)
+        task.add_done_callback(lambda _: self.refresh_over(key, task))
+
+    def refresh_over(self, key, task):
+        self.cache.refresh_done(key)
+        if not task.cancelled():
+            # Failures only leave the cached answer to expire
+            task.exception()
+
+    async def lookup(self, builder, packet, key):
+        data = await self.exchange(packet)
+        if self.cache is not None:
+            self.cache.put(key, data, builder.length)
+        return self.decode(data, builder)
+
+    def done(self, key, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+
+    def new_id(self):
+        '''A query ID that is not used by any query in flight'''
+        if len(self.pending) + len(self.tcp_pending) >= 65536:
+            raise RuntimeError('All query IDs are in use')
+        q_id = new_query_id()
+        while q_id in self.pending or q_id in self.tcp_pending:
+            q_id = new_query_id()
+        return q_id
+
+    async def exchange(self, packet):
+        '''
+        Sends the query packet and returns the raw answer to it, asked
+        again over TCP if it was truncated. The query goes out with an
+        ID from new_id, picked and registered in one step so that no
+        other query can take it in between, and the answer is handed
+        back with the ID of packet.
+        '''
+        if self.transport is None:
+            raise ConnectionError('Resolver is not open')
+        if self.tcp:
+            return await self.exchange_tcp(packet)
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        entry = AsyncQuery(loop.create_future(),
+                           with_id(packet, self.new_id()), now,
+                           now + self.timeout)
+        self.pending[entry.q_id] = entry
+        self.send(entry)
+        try:
+            data = await entry.future
+        finally:
+            if self.pending.get(entry.q_id) is entry:
+                del self.pending[entry.q_id]
+                entry.handle.cancel()
+
+        if is_truncated(data):
+            if instrument.recorder is not None:
+                instrument.recorder.count('truncated')
+            return await self.exchange_tcp(packet)
+        return packet[:2] + data[2:]
+
+    def send(self, entry):
+        '''Sends the query and sets the timer of its next retry'''
+        loop = asyncio.get_running_loop()
+        entry.tries += 1
+        if entry.tries > 1 and instrument.recorder is not None:
+            instrument.recorder.count('retries')
+        backoff = self.selector.backoff(self.server, entry.tries)
+        delay = min(backoff, entry.expires - loop.time())
+        entry.handle = loop.call_later(delay, self.expire, entry)
+        self.transport.sendto(entry.packet)
+
+    def expire(self, entry):
+        '''Sends the query again, or fails it once its timeout ran out'''
+        loop = asyncio.get_running_loop()
+        if loop.time() < entry.expires and self.transport is not None:
+            self.send(entry)
+            return
+
+        if self.pending.get(entry.q_id) is entry:
+            del self.pending[entry.q_id]
+        self.selector.record_failure(self.server)
+        if not entry.future.done():
+            entry.future.set_exception(QueryTimeout(
+                [self.server], entry.tries, loop.time() - entry.started))
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        q_id = (data[0] << 8) | data[1]
+        entry = self.pending.pop(q_id, None)
+        if entry is None:
+            return
+        entry.handle.cancel()
+        if entry.tries == 1:
+            loop = asyncio.get_running_loop()
+            self.selector.record_rtt(self.server, loop.time() - entry.started)
+        if not entry.future.done():
+            entry.future.set_result(data)
+
+    async def exchange_tcp(self, packet):
+        '''
+        Sends the packet over the TCP connection, opening it if needed,
+        and waits for the answer having the same query ID. The ID is
+        replaced the way exchange does it.
+        '''
+        async with self.tcp_lock:
+            if self.tcp_writer is None or self.tcp_writer.is_closing():
+                reader, self.tcp_writer = await asyncio.wait_for(
+                    asyncio.open_connection(*self.server), self.timeout)
+                asyncio.get_running_loop().create_task(
+                    self.read_tcp(reader, self.tcp_writer))
+
+        q_id = self.new_id()
+        future = asyncio.get_running_loop().create_future()
+        self.tcp_pending[q_id] = future
+        try:
+            self.tcp_writer.write(frame(with_id(packet, q_id)))
+            data = await asyncio.wait_for(future, self.timeout)
+            return packet[:2] + data[2:]
+        finally:
+            if self.tcp_pending.get(q_id) is future:
+                del self.tcp_pending[q_id]
+
+    async def read_tcp(self, reader, writer):
+        '''Hands the answers read from the connection to their queries'''
+        error = ConnectionError('TCP connection closed')
+        try:
+            while True:
+                length = length_struct.unpack(await reader.readexactly(2))[0]
+                data = await reader.readexactly(length)
+                future = self.tcp_pending.pop((data[0] << 8) | data[1], None)
+                if future is not None and not future.done():
+                    future.set_result(data)
+        except (asyncio.IncompleteReadError, OSError) as exc:
+            error = ConnectionError('TCP connection lost: {}'.format(exc))
+        finally:
+            writer.close()
+            if self.tcp_writer is writer:
+                self.tcp_writer = None
+
+        for future in self.tcp_pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.tcp_pending.clear()
+
+    def decode(self, data, builder):
+        response = DnsResponseBuilder(data, builder.length, builder.url,
+                                      builder.q_id)
+        response.create_header()
+        response.error_check()
+        if not response.is_valid:
+            raise DnsError(*response.error)
+
+        response.parse()
+        return list(response.answer_records)
+
+
+if __name__ == '__main__':
+    print('This is the file for the asyncio resolver, run dns.py instead')
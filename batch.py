@@ -0,0 +1,502 @@
+import heapq
+import itertools
+import select
+import struct
+import time
+import instrument
+from cache import DnsCache
+from query import DnsQueryBuilder, new_query_id
+from ratelimit import AimdWindow, TokenBucket
+from servers import QueryTimeout, ServerSelector, rcode_of
+from transport import TcpConnectionPool, UdpSocketPool, is_truncated
+
+
+class BatchLineError(ValueError):
+    '''A line of a batch file that asks for an unknown query type'''
+
+
+def read_batch(stream, default_rtype='A', rtypes=None):
+    '''
+    Reads the names to be resolved from a file like object.
+    Every line holds a name and optionally the query type, eg:
+        google.com
+        google.com MX
+    Blank lines and lines starting with '#' are skipped.
+    The lines are yielded lazily as (url, rtype) pairs. With rtypes
+    given, a query type not in it raises BatchLineError, naming the
+    line it is on.
+    '''
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if line == '' or line[0] == '#':
+            continue
+        data = line.split()
+        if len(data) == 1:
+            yield data[0], default_rtype
+            continue
+        rtype = data[1].upper()
+        if rtypes is not None and rtype not in rtypes:
+            raise BatchLineError(
+                "{} line {}: invalid query type: '{}' (choose from {})"
+                .format(getattr(stream, 'name', 'batch'), number, data[1],
+                        ', '.join("'{}'".format(name) for name in rtypes)))
+        yield data[0], rtype
+
+
+class PendingQuery:
+    '''
+    A query that is in flight. server is the one it was last sent to,
+    tried counts the sends per server, deadline is the time of the next
+    retry and expires the time at which the query times out.
+    waiters are the (url, rtype, builder) of the items asking the same
+    question, which get the answer of this query.
+    '''
+    __slots__ = ('url', 'rtype', 'builder', 'packet', 'key', 'started',
+                 'expires', 'deadline', 'server', 'sent', 'tries', 'tried',
+                 'failed', 'waiters')
+
+    def __init__(self, url, rtype, builder, packet, key=None, timeout=None):
+        self.url = url
+        self.rtype = rtype
+        self.builder = builder
+        self.packet = packet
+        self.key = key
+        self.started = time.monotonic()
+        self.expires = None
+        if timeout is not None:
+            self.expires = self.started + timeout
+        self.deadline = None
+        self.server = None
+        self.sent = None
+        self.tries = 0
+        self.tried = {}
+        self.failed = []
+        self.waiters = []
+
+    def send(self, sock, server):
+        self.server = server
+        self.sent = time.monotonic()
+        self.tries += 1
+        if self.tries > 1 and instrument.recorder is not None:
+            instrument.recorder.count('retries')
+        self.tried[server] = self.tried.get(server, 0) + 1
+        sock.sendto(self.packet, server)
+
+    def timed_out(self):
+        return QueryTimeout(self.tried, self.tries,
+                            time.monotonic() - self.started)
+
+
+class BatchResolver:
+    '''
+    Resolves many names over a single UDP socket.
+    Up to concurrency queries are kept in flight at once, the replies
+    are matched back to their queries using the query ID and results
+    are handed out in the order in which they complete.
+    Items asking a question that is already in flight do not send a
+    query of their own, they get the answer of the one in flight.
+    Every query goes to the server with the lowest smoothed RTT. An
+    unanswered query is sent again with the same ID, to the next server
+    in turn, each time its backoff runs out, and one answered with
+    SERVFAIL or REFUSED moves on to the next server right away.
+    dns is a server, a list of servers or a ServerSelector.
+    Truncated answers are fetched again over pooled TCP connections,
+    with tcp set every query goes over them.
+    With rate set, at most rate new queries are sent per second, or
+    as many as limiter allows, a TokenBucket that may be shared.
+    With server_rate set, at most server_rate queries, retries
+    included, are sent per second to each server, server_limiters
+    may give the TokenBucket of some servers.
+    With adaptive set, the number of queries in flight follows an
+    AimdWindow of at most concurrency, cut on timeouts, SERVFAIL and
+    REFUSED and grown while the answers come back fine, so that an
+    upstream that starts dropping queries is not pushed any harder.
+    '''
+
+    def __init__(self, dns, port=53, concurrency=100, timeout=5,
+                 recurse=False, cache=None, tcp=False, tcp_pool=None,
+                 bufsize=1232, udp_pool=None, rate=None, limiter=None,
+                 server_rate=None, server_limiters=None, adaptive=False):
+        if not isinstance(dns, ServerSelector):
+            dns = ServerSelector(dns, port)
+        self.selector = dns
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = timeout
+        self.recurse = recurse
+        self.cache = cache
+        self.tcp = tcp
+        if tcp_pool is None:
+            tcp_pool = TcpConnectionPool(timeout)
+        self.tcp_pool = tcp_pool
+        self.bufsize = bufsize
+        if udp_pool is None:
+            udp_pool = UdpSocketPool(1)
+        self.udp_pool = udp_pool
+        if limiter is None and rate:
+            limiter = TokenBucket(rate)
+        self.limiter = limiter
+        self.server_rate = server_rate
+        self.server_limiters = dict(server_limiters or {})
+        self.window = None
+        if adaptive:
+            self.window = AimdWindow(self.concurrency)
+            if instrument.recorder is not None:
+                instrument.recorder.gauge('window maximum', self.concurrency)
+        self.pending = {}
+        self.inflight = {}
+        self.timers = []
+        self.sequence = itertools.count()
+
+    def new_query(self, url, rtype):
+        '''
+        Builds the query packet, making sure that its ID is not
+        already used by another query that is in flight.
+        '''
+        builder = DnsQueryBuilder(self.bufsize)
+        while builder.q_id in self.pending:
+            builder.q_id = new_query_id()
+        packet = builder.build_query_packet(url, rtype, self.recurse)
+        return builder, packet
+
+    def prepare(self, url, rtype, timeout=None):
+        '''
+        Builds the query of an item and returns (entry, result).
+        On a cache hit result is the result to hand out. If the same
+        question is already in flight the item waits for it and both
+        are None, otherwise entry is the new PendingQuery to send.
+        A name that cannot be encoded, like one with a label over 63
+        bytes, fails alone: result carries its ValueError.
+        '''
+        try:
+            builder, packet = self.new_query(url, rtype)
+        except ValueError as error:
+            return None, (url, rtype, None, error, None, None)
+        key = DnsCache.key(builder, packet)
+        if self.cache is not None:
+            data = self.cache.get(key, builder.q_id)
+            if data is not None:
+                return None, (url, rtype, builder, data, None, None)
+
+        leader = self.inflight.get(key)
+        if leader is not None:
+            leader.waiters.append((url, rtype, builder))
+            return None, None
+
+        entry = PendingQuery(url, rtype, builder, packet, key, timeout)
+        self.inflight[key] = entry
+        return entry, None
+
+    def results(self, entry, data):
+        '''
+        The results of the entry and of the items waiting for it, the
+        answer is handed to each of them with its own query ID. The
+        round trip time runs from the first send, retries included.
+        '''
+        if self.inflight.get(entry.key) is entry:
+            del self.inflight[entry.key]
+        if isinstance(data, bytes) and self.cache is not None:
+            self.cache.put(entry.key, data, entry.builder.length)
+
+        server = rtt = None
+        if isinstance(data, bytes):
+            server = entry.server
+            rtt = time.monotonic() - entry.started
+
+        yield entry.url, entry.rtype, entry.builder, data, server, rtt
+        for url, rtype, builder in entry.waiters:
+            if isinstance(data, bytes):
+                yield url, rtype, builder, \
+                    struct.pack('!H', builder.q_id) + data[2:], server, rtt
+            else:
+                yield url, rtype, builder, data, server, rtt
+
+    def resolve(self, items):
+        '''
+        Generator taking an iterable of (url, rtype) pairs, where
+        rtype is in the byte format used by DnsQueryBuilder. While
+        queries are pending the iterable can give None instead, when
+        it has no name ready, so that their answers are not held up.
+        Yields (url, rtype, builder, data, server, rtt) in completion
+        order, data is a QueryTimeout if the query timed out, the
+        OSError if it could not be sent or asking it again over TCP
+        failed, or the ValueError if the name could not be encoded,
+        with builder None. server
+        and rtt are None for failures and answers from the cache.
+        '''
+        if self.tcp:
+            yield from self.resolve_tcp(items)
+            return
+
+        items = iter(items)
+        exhausted = False
+        sock = self.udp_pool.acquire()
+        sock.setblocking(False)
+
+        try:
+            while True:
+                # Filling the window with new queries
+                limited = 0
+                while not exhausted and len(self.pending) < self.limit():
+                    if self.limiter is not None:
+                        limited = self.limiter.delay()
+                        if limited:
+                            break
+                    server = self.selector.best()
+                    server_limiter = self.server_limiter(server)
+                    if server_limiter is not None:
+                        limited = server_limiter.delay()
+                        if limited:
+                            break
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if item is None:
+                        break
+                    url, rtype = item
+                    entry, result = self.prepare(url, rtype, self.timeout)
+                    if result is not None:
+                        yield result
+                    if entry is None:
+                        continue
+                    if self.limiter is not None:
+                        self.limiter.take()
+                    self.pending[entry.builder.q_id] = entry
+                    error = self.send(sock, entry, server)
+                    if error is not None:
+                        yield from self.fail(entry, error)
+
+                if not self.pending and not limited:
+                    break
+
+                wait = self.timeout
+                if self.timers:
+                    wait = min(wait, self.timers[0][0] - time.monotonic())
+                if limited:
+                    wait = min(wait, limited)
+                wait = max(0, wait)
+                readable, _, _ = select.select([sock], [], [], wait)
+
+                if readable:
+                    truncated = []
+                    for data, q_id, server in self.receive(sock):
+                        entry = self.pending.get(q_id)
+                        if entry is None:
+                            continue
+                        # Karn: the answer to a resent query gives no sample
+                        if entry.tries == 1:
+                            self.selector.record_rtt(
+                                server, time.monotonic() - entry.sent)
+                        entry.server = server
+                        if rcode_of(data) in (2, 5):
+                            if self.window is not None:
+                                self.window.failure()
+                            if self.failover(sock, entry):
+                                continue
+                        elif self.window is not None:
+                            self.window.success()
+                        del self.pending[q_id]
+                        if is_truncated(data):
+                            truncated.append(entry)
+                            continue
+                        yield from self.results(entry, data)
+
+                    if truncated:
+                        if instrument.recorder is not None:
+                            instrument.recorder.count('truncated',
+                                                      len(truncated))
+                        yield from self.retry_tcp(truncated)
+
+                now = time.monotonic()
+                while self.timers and self.timers[0][0] <= now:
+                    deadline, _, entry = heapq.heappop(self.timers)
+                    q_id = entry.builder.q_id
+                    # Timers of answered or rescheduled queries are stale
+                    if self.pending.get(q_id) is not entry or \
+                            entry.deadline != deadline:
+                        continue
+                    if self.window is not None:
+                        self.window.failure()
+                    if deadline < entry.expires:
+                        error = self.retransmit(sock, entry)
+                        if error is not None:
+                            yield from self.fail(entry, error)
+                        continue
+                    yield from self.fail(entry, entry.timed_out())
+
+        finally:
+            self.pending.clear()
+            self.inflight.clear()
+            self.timers.clear()
+            self.udp_pool.release(sock)
+
+    def limit(self):
+        '''The number of queries that may be in flight now'''
+        if self.window is None:
+            return self.concurrency
+        return self.window.limit()
+
+    def server_limiter(self, server):
+        '''The TokenBucket of the server, None without server_rate'''
+        limiter = self.server_limiters.get(server)
+        if limiter is None and self.server_rate:
+            limiter = TokenBucket(self.server_rate)
+            self.server_limiters[server] = limiter
+        return limiter
+
+    def send(self, sock, entry, server):
+        '''
+        Sends the query and sets the timer of its next retry. Returns
+        the OSError if it could not be sent, like EACCES for a
+        broadcast address or ENETUNREACH, None once it is sent.
+        '''
+        limiter = self.server_limiter(server)
+        if limiter is not None:
+            limiter.take()
+        try:
+            entry.send(sock, server)
+        except OSError as error:
+            return error
+        backoff = self.selector.backoff(server, entry.tried[server])
+        entry.deadline = min(entry.sent + backoff, entry.expires)
+        heapq.heappush(self.timers,
+                       (entry.deadline, next(self.sequence), entry))
+        return None
+
+    def fail(self, entry, error):
+        '''Gives up on the pending entry, error being its result'''
+        del self.pending[entry.builder.q_id]
+        self.selector.record_failure(entry.server)
+        yield from self.results(entry, error)
+
+    def servers(self, entry):
+        '''The servers that may still be asked, fastest first'''
+        return [server for server in self.selector.ordered()
+                if server not in entry.failed]
+
+    def retransmit(self, sock, entry):
+        '''
+        Sends the query again, to the next server in turn, returns
+        the OSError if it could not be sent
+        '''
+        servers = self.servers(entry)
+        if not servers:
+            servers = [entry.server]
+        return self.send(sock, entry, servers[entry.tries % len(servers)])
+
+    def failover(self, sock, entry):
+        '''
+        Sends the query again, with the same ID, to the fastest server
+        that did not fail it yet. Returns False if every server did,
+        or if it could not be sent, so the failed answer stands.
+        '''
+        self.selector.record_failure(entry.server)
+        entry.failed.append(entry.server)
+        servers = self.servers(entry)
+        if not servers:
+            return False
+        if instrument.recorder is not None:
+            instrument.recorder.count('failovers')
+        return self.send(sock, entry, servers[0]) is None
+
+    def resolve_tcp(self, items):
+        '''
+        Resolves the items over TCP, concurrency queries at a
+        time are pipelined over one pooled connection. The rate
+        limits hold back each query before it joins a batch, and
+        with adaptive set a batch is only as big as the window.
+        '''
+        items = iter(items)
+        while True:
+            chunk = []
+            size = self.limit()
+            for item in items:
+                if item is None:
+                    if chunk:
+                        break
+                    continue
+                url, rtype = item
+                entry, result = self.prepare(url, rtype)
+                if result is not None:
+                    yield result
+                if entry is None:
+                    continue
+                entry.server = self.selector.best()
+                self.throttle(entry.server)
+                self.pending[entry.builder.q_id] = entry
+                chunk.append(entry)
+                if len(chunk) >= size:
+                    break
+
+            if not chunk:
+                break
+            self.pending.clear()
+            yield from self.retry_tcp(chunk, adapt=True)
+
+    def throttle(self, server):
+        '''
+        Waits until --rate and --server_rate let one more query go to
+        the server, for the TCP path that cannot wait in select
+        '''
+        for limiter in (self.limiter, self.server_limiter(server)):
+            if limiter is None:
+                continue
+            delay = limiter.delay()
+            while delay > 0:
+                time.sleep(delay)
+                delay = limiter.delay()
+            limiter.take()
+
+    def retry_tcp(self, entries, adapt=False):
+        '''
+        Sends the queries of the pending entries over TCP, to the
+        server each of them was last sent to. With adapt set, the
+        answers grow or cut the window, as the UDP ones do.
+        '''
+        by_server = {}
+        for entry in entries:
+            by_server.setdefault(entry.server, []).append(entry)
+
+        for server, entries in by_server.items():
+            packets = [entry.packet for entry in entries]
+            try:
+                answers = self.tcp_pool.exchange_many(server, packets)
+            except OSError as exc:
+                answers = [exc] * len(entries)
+
+            for entry, data in zip(entries, answers):
+                if adapt and self.window is not None:
+                    if isinstance(data, bytes) and \
+                            rcode_of(data) not in (2, 5):
+                        self.window.success()
+                    else:
+                        self.window.failure()
+                yield from self.results(entry, data)
+
+    def receive(self, sock):
+        '''
+        Drains every datagram that is waiting on the socket and returns
+        those which answer a pending query and come from a server that
+        query was sent to.
+        '''
+        replies = []
+        while True:
+            try:
+                data, addr = sock.recvfrom(max(self.bufsize, 512))
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionRefusedError:
+                continue
+            if len(data) < 12:
+                continue
+            q_id = (data[0] << 8) | data[1]
+            entry = self.pending.get(q_id)
+            if entry is not None and addr[:2] in entry.tried:
+                replies.append((data, q_id, addr[:2]))
+
+        return replies
+
+
+if __name__ == '__main__':
+    print('This is the file for the batch resolver, run dns.py instead')
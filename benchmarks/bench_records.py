@@ -0,0 +1,79 @@
+'''
+Memory per parsed record, dict records against the __slots__ model.
+The same responses of A and MX answers are parsed both ways and the
+memory kept alive by the records is measured with tracemalloc.
+
+    python benchmarks/bench_records.py
+'''
+import os
+import sys
+import struct
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from wire import WireParser  # noqa: E402
+
+
+def build_response(q_id, rtype, count):
+    '''A response to example.com with count answers of the given type'''
+    question = b'\x07example\x03com\x00' + struct.pack('!HH', rtype, 1)
+    header = struct.pack('!HHHHHH', q_id, 33152, 1, count, 0, 0)
+    answers = []
+    for index in range(count):
+        if rtype == 1:
+            rdata = bytes([10, 0, index // 256, index % 256])
+        else:
+            label = 'mx{}'.format(index).encode('utf-8')
+            rdata = struct.pack('!HB', index, len(label)) + label + \
+                b'\xc0\x0c'
+        answers.append(b'\xc0\x0c' + struct.pack('!HHLH', rtype, 1, 300,
+                                                 len(rdata)) + rdata)
+
+    return header + question + b''.join(answers), 12 + len(question)
+
+
+def legacy_parse(data, start, count):
+    '''The dict records as made by DnsResponseBuilder.parse before'''
+    records = []
+    for _ in range(count):
+        tuple_data_dns = struct.unpack('!HHHLH', data[start:start + 12])
+        data_to_pass = {}
+        data_to_pass['name'] = tuple_data_dns[0]
+        data_to_pass['qtype'] = tuple_data_dns[1]
+        data_to_pass['qclass'] = tuple_data_dns[2]
+        data_to_pass['ttl'] = tuple_data_dns[3]
+        data_to_pass['response_length'] = tuple_data_dns[4]
+        data_to_pass['response_data'] = \
+            data[start + 12:start + 12 + tuple_data_dns[4]]
+        start += data_to_pass['response_length'] + 12
+        records.append(data_to_pass)
+
+    return records
+
+
+def measure(parse, responses):
+    tracemalloc.start()
+    kept = [parse(data, length) for data, length in responses]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / sum(len(records) for records in kept)
+
+
+def run(messages=1000, count=100):
+    for rtype, label in ((1, 'A'), (15, 'MX')):
+        responses = [build_response(q_id, rtype, count)
+                     for q_id in range(messages)]
+        before = measure(lambda data, length:
+                         legacy_parse(data, length, count), responses)
+        after = measure(lambda data, length:
+                        list(WireParser(data).parse().answer),
+                        responses)
+        print('{:<4}dict: {:>6.0f} B/record  slots: {:>6.0f} B/record  '
+              '({:.1f}x smaller)'.format(label, before, after,
+                                         before / after))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,124 @@
+'''
+Start-up cost of dns.py, for shell loops and health checks that run
+it once per name. Measures:
+
+    wall      seconds of a whole single lookup, in a new interpreter,
+              against the in-process fake server of fakeserver.py,
+              next to the seconds of an empty interpreter
+    imports   the -X importtime report of that lookup: the total time
+              spent importing and the modules costing the most,
+              counted with everything they import in turn
+
+The results are written as JSON, so that runs can be compared:
+
+    python benchmarks/bench_startup.py --output=startup.json
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+from fakeserver import FakeDnsServer  # noqa: E402
+
+dns_script = os.path.join(here, '..', 'dns.py')
+
+
+def lookup_command(server):
+    return [sys.executable, dns_script, 'a0.bench', '--dns_ip=' + server.host,
+            '--port={}'.format(server.port), '--timeout=2']
+
+
+def wall(command, runs):
+    '''Best and median seconds of runs of the command'''
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - started)
+    times.sort()
+    return {'best_ms': round(times[0] * 1000, 2),
+            'median_ms': round(times[len(times) // 2] * 1000, 2)}
+
+
+def import_times(command, top):
+    '''
+    The -X importtime report as (module, self us, cumulative us), the
+    top modules imported by nothing else of the report
+    '''
+    report = subprocess.run(command[:1] + ['-X', 'importtime'] + command[1:],
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, check=True,
+                            universal_newlines=True).stderr
+    rows = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, total, name = line[len('import time:'):].split('|')
+        # Nesting is shown by two spaces per level before the name
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), int(own), int(total), depth))
+
+    outermost = sorted((row for row in rows if row[3] == 0),
+                       key=lambda row: -row[2])
+    return {'modules': len(rows),
+            'total_ms': round(sum(row[1] for row in rows) / 1000, 2),
+            'top': [{'module': name, 'cumulative_ms': round(total / 1000, 2)}
+                    for name, _, total, _ in outermost[:top]]}
+
+
+def run(args):
+    server = FakeDnsServer().start()
+    try:
+        command = lookup_command(server)
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        return {'meta': {'python': platform.python_version(),
+                         'implementation': platform.python_implementation(),
+                         'platform': platform.platform(),
+                         'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                         'runs': args.runs},
+                'wall': {'interpreter': wall([sys.executable, '-c', 'pass'],
+                                             args.runs),
+                         'lookup': wall(command, args.runs)},
+                'imports': import_times(command, args.top)}
+    finally:
+        server.stop()
+
+
+def summary(results):
+    lines = ['interpreter   best {best_ms:>8} ms  median {median_ms:>8} ms'
+             .format(**results['wall']['interpreter']),
+             'lookup        best {best_ms:>8} ms  median {median_ms:>8} ms'
+             .format(**results['wall']['lookup']),
+             'imports {} modules, {} ms'.format(
+                 results['imports']['modules'],
+                 results['imports']['total_ms'])]
+    for row in results['imports']['top']:
+        lines.append('    {module:<24}{cumulative_ms:>8} ms'.format(**row))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='dns.py start-up benchmark')
+    p.add_argument('--runs', type=int, default=20,
+                   help='Lookups timed, the best and median are kept')
+    p.add_argument('--top', type=int, default=15,
+                   help='Number of the costliest imports listed')
+    p.add_argument('--output', default=None,
+                   help='File to write the JSON results to, default stdout')
+    args = p.parse_args()
+
+    results = run(args)
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as stream:
+            json.dump(results, stream, indent=2)
+        print(summary(results))
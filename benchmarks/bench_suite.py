@@ -0,0 +1,216 @@
+'''
+Throughput and latency of the resolver against the in-process fake
+server of fakeserver.py, entirely offline. Measures:
+
+    codec     query packets encoded and responses decoded per second,
+              for every kind of canned response
+    lookups   lookups per second through BatchResolver at each
+              concurrency level, with their p50 and p99 latency, over
+              UDP, over TCP, and for answers truncated over UDP
+    memory    peak memory traced while resolving a batch
+
+The results are written as JSON, so that runs can be compared:
+
+    python benchmarks/bench_suite.py --output=before.json
+    python benchmarks/bench_suite.py --loss=0.02 --latency=0.001
+'''
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from batch import BatchResolver  # noqa: E402
+from fakeserver import FakeDnsServer, canned_response, kinds  # noqa: E402
+from output import make_result  # noqa: E402
+from query import DnsQueryBuilder, encode_question  # noqa: E402
+from transport import TcpConnectionPool, UdpSocketPool  # noqa: E402
+
+# The query type asked for each kind of canned response
+kind_types = {'a': b'A', 'aaaa': b'AAAA', 'mx': b'MX', 'soa': b'SOA',
+              'txt': b'TXT', 'ns': b'NS', 'compress': b'NS', 'big': b'TXT',
+              'nx': b'A'}
+
+
+def percentile(values, fraction):
+    '''The nearest-rank percentile of the sorted values'''
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def rate(func, count, repeat=5):
+    '''Best of repeat runs of func, which does count operations'''
+    return count / min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def bench_codec(number):
+    '''Encode and decode operations per second'''
+    names = ['{}{}.bench'.format(kind, index)
+             for index in range(number) for kind in kinds]
+    builder = DnsQueryBuilder()
+
+    def encode():
+        for name in names:
+            builder.build_query_packet(name, b'A', 1)
+
+    def encode_uncached():
+        encode_question.cache_clear()
+        encode()
+
+    encode()
+    results = {'encode': rate(encode, len(names)),
+               'encode_uncached': rate(encode_uncached, len(names)),
+               'decode': {}}
+
+    for kind in kinds:
+        builder = DnsQueryBuilder()
+        url = kind + '.bench'
+        data = canned_response(
+            builder.build_query_packet(url, kind_types[kind], 1), tcp=True)
+
+        def decode():
+            for _ in range(number):
+                result = make_result(data, builder.length, builder.url,
+                                     builder.q_id, kind_types[kind])
+                for _ in result.rows():
+                    pass
+
+        results['decode'][kind] = rate(decode, number)
+
+    return results
+
+
+def lookup_items(count, kind_list, run):
+    '''count (url, rtype) pairs, unique so nothing is coalesced'''
+    return [('{}{}.run{}.bench'.format(kind_list[index % len(kind_list)],
+                                        index, run),
+             kind_types[kind_list[index % len(kind_list)]])
+            for index in range(count)]
+
+
+def bench_lookups(server, count, concurrency, timeout, tcp=False,
+                  kind_list=('a', 'aaaa', 'mx', 'txt', 'ns'), run=0):
+    '''Lookups per second and latency of one batch'''
+    items = lookup_items(count, kind_list, run)
+    udp_pool = UdpSocketPool(1)
+    tcp_pool = TcpConnectionPool(timeout)
+    resolver = BatchResolver(server.host, server.port, concurrency, timeout,
+                             True, None, tcp, tcp_pool, 1232, udp_pool)
+    latencies = []
+    failures = 0
+    started = time.monotonic()
+    for _, _, _, data, _, rtt in resolver.resolve(items):
+        if isinstance(data, bytes):
+            latencies.append(rtt)
+        else:
+            failures += 1
+    elapsed = time.monotonic() - started
+    udp_pool.close()
+    tcp_pool.close()
+
+    latencies.sort()
+    return {'transport': 'tcp' if tcp else 'udp',
+            'kinds': list(kind_list),
+            'concurrency': concurrency,
+            'lookups': count,
+            'failures': failures,
+            'seconds': round(elapsed, 4),
+            'lookups_per_second': round(count / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 3)
+            if latencies else None,
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3)
+            if latencies else None}
+
+
+def bench_memory(server, count, concurrency, timeout):
+    '''Peak memory traced while resolving count names, in KiB'''
+    tracemalloc.start()
+    bench_lookups(server, count, concurrency, timeout, run='memory')
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'lookups': count, 'concurrency': concurrency,
+            'peak_kib': round(peak / 1024, 1)}
+
+
+def run(args):
+    levels = [int(level) for level in args.concurrency.split(',')]
+    server = FakeDnsServer(loss=args.loss, latency=args.latency).start()
+    try:
+        results = {
+            'meta': {'python': platform.python_version(),
+                     'implementation': platform.python_implementation(),
+                     'platform': platform.platform(),
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                     'loss': args.loss, 'latency': args.latency},
+            'codec': bench_codec(args.codec),
+            'lookups': [],
+        }
+        run_number = 0
+        for tcp, kind_list in ((False, ('a', 'aaaa', 'mx', 'txt', 'ns')),
+                               (True, ('a', 'aaaa', 'mx', 'txt', 'ns')),
+                               (False, ('big',))):
+            for level in levels:
+                run_number += 1
+                results['lookups'].append(bench_lookups(
+                    server, args.lookups, level, args.timeout, tcp,
+                    kind_list, run_number))
+        results['memory'] = bench_memory(server, args.lookups, max(levels),
+                                         args.timeout)
+        results['meta']['server_received'] = server.received
+        results['meta']['server_dropped'] = server.dropped
+    finally:
+        server.stop()
+
+    return results
+
+
+def summary(results):
+    lines = ['encode {:>12,.0f} ops/s   uncached {:>12,.0f} ops/s'.format(
+        results['codec']['encode'], results['codec']['encode_uncached'])]
+    for kind, ops in results['codec']['decode'].items():
+        lines.append('decode {:<9}{:>10,.0f} ops/s'.format(kind, ops))
+    for row in results['lookups']:
+        lines.append('{} {:<16} c={:<5}{:>10,.0f} lookups/s  p50 {} ms  '
+                     'p99 {} ms  failed {}'.format(
+                         row['transport'], ','.join(row['kinds']),
+                         row['concurrency'], row['lookups_per_second'],
+                         row['p50_ms'], row['p99_ms'], row['failures']))
+    lines.append('peak memory {} KiB for {} lookups'.format(
+        results['memory']['peak_kib'], results['memory']['lookups']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='DNS resolver benchmarks')
+    p.add_argument('--lookups', type=int, default=2000,
+                   help='Lookups per batch, eg: --lookups=2000')
+    p.add_argument('--concurrency', default='1,10,100',
+                   help='Comma separated concurrency levels, eg: 1,10,100')
+    p.add_argument('--codec', type=int, default=2000,
+                   help='Messages per encode and decode run')
+    p.add_argument('--loss', type=float, default=0.0,
+                   help='Fraction of UDP answers the server drops')
+    p.add_argument('--latency', type=float, default=0.0,
+                   help='Seconds the server waits before answering')
+    p.add_argument('--timeout', type=float, default=5,
+                   help='Timeout of each lookup in seconds')
+    p.add_argument('--output', default=None,
+                   help='File to write the JSON results to, default stdout')
+    args = p.parse_args()
+
+    results = run(args)
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as stream:
+            json.dump(results, stream, indent=2)
+        print(summary(results))
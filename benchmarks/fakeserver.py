@@ -0,0 +1,243 @@
+'''
+In-process DNS server answering canned responses over UDP and TCP,
+so the benchmarks run without any network access.
+
+The first label of the question picks the answer, with any trailing
+digits ignored so that names can be made unique, eg: mx17.bench
+
+    a         one A record
+    aaaa      one AAAA record
+    mx        five MX records
+    soa       the SOA record of the zone
+    txt       a TXT record of several strings
+    ns        a large NS set of 13 servers, with A glue for each
+    compress  20 NS names each one label above the one before it, all
+              written with compression pointers, with A glue
+    big       40 TXT records of 200 bytes, truncated over UDP
+    nx        NXDOMAIN with the SOA record in the authority section
+
+Anything else is answered with one A record. UDP answers can be
+dropped (loss, a fraction) and delayed (latency, seconds), TCP ones
+are only delayed. With limit set, like an upstream rate limiting its
+clients, UDP queries over limit per second are answered REFUSED.
+
+    server = FakeDnsServer(loss=0.01, latency=0.002).start()
+    ... ask server.host on server.port ...
+    server.stop()
+'''
+import heapq
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+header_struct = struct.Struct('!HHHHHH')
+record_struct = struct.Struct('!HHLH')
+length_struct = struct.Struct('!H')
+
+kinds = ('a', 'aaaa', 'mx', 'soa', 'txt', 'ns', 'compress', 'big', 'nx')
+
+
+def encode_name(labels):
+    return b''.join(bytes([len(label)]) + label for label in labels) + b'\x00'
+
+
+def record(owner, rtype, rdata, ttl=300):
+    return owner + record_struct.pack(rtype, 1, ttl, len(rdata)) + rdata
+
+
+def read_question(query):
+    '''The question bytes and the first label without trailing digits'''
+    index = 12
+    first = None
+    while query[index]:
+        length = query[index]
+        if first is None:
+            first = query[index + 1:index + 1 + length]
+        index += length + 1
+    end = index + 5
+    return query[12:end], (first or b'').rstrip(b'0123456789')
+
+
+def refused_response(query):
+    q_id, flags = struct.unpack_from('!HH', query, 0)
+    question, _ = read_question(query)
+    return header_struct.pack(q_id, 32768 | (flags & 256) | 128 | 5, 1, 0,
+                              0, 0) + question
+
+
+def canned_response(query, tcp=False):
+    '''The response to the query, as the fake server sends it'''
+    q_id, flags = struct.unpack_from('!HH', query, 0)
+    question, kind = read_question(query)
+    flags = 32768 | (flags & 256) | 128
+    here = b'\xc0\x0c'
+    answer, authority, additional = [], [], []
+
+    soa = record(here, 6, b'\x02ns' + here + b'\x04mail' + here +
+                 struct.pack('!LLLLL', 2024010101, 7200, 900, 1209600, 300))
+    if kind == b'aaaa':
+        answer.append(record(here, 28, bytes(range(32, 48))))
+    elif kind == b'mx':
+        for index in range(5):
+            answer.append(record(here, 15, struct.pack('!H', index * 10) +
+                                 b'\x03mx' + bytes([48 + index]) + here))
+    elif kind == b'soa':
+        answer.append(soa)
+    elif kind == b'txt':
+        strings = (b'v=spf1 include:_spf.bench ~all', b'x' * 100,
+                   b'benchmark')
+        answer.append(record(here, 16, b''.join(
+            bytes([len(string)]) + string for string in strings)))
+    elif kind == b'ns':
+        names = [encode_name([chr(97 + index).encode('utf-8'),
+                              b'nameservers', b'bench', b'net'])
+                 for index in range(13)]
+        for name in names:
+            answer.append(record(here, 2, name))
+        for index, name in enumerate(names):
+            additional.append(record(name, 1, bytes([10, 0, 0, index])))
+    elif kind == b'compress':
+        # Every name is a label and a pointer to the one before it
+        offset = 12 + len(question)
+        previous = 12
+        for index in range(20):
+            rdata = bytes([2]) + 'n{}'.format(index % 10).encode('utf-8') + \
+                struct.pack('!H', 49152 | previous)
+            answer.append(record(here, 2, rdata))
+            previous = offset + 12
+            offset += 12 + len(rdata)
+            additional.append(record(struct.pack('!H', 49152 | previous), 1,
+                                     bytes([10, 1, 0, index])))
+    elif kind == b'big':
+        if not tcp:
+            flags |= 512
+        else:
+            for index in range(40):
+                answer.append(record(here, 16, bytes([200]) +
+                                     bytes([97 + index % 26]) * 200))
+    elif kind == b'nx':
+        flags |= 3
+        authority.append(soa)
+    else:
+        answer.append(record(here, 1, bytes([192, 0, 2, 1])))
+
+    return header_struct.pack(q_id, flags, 1, len(answer), len(authority),
+                              len(additional)) + question + \
+        b''.join(answer) + b''.join(authority) + b''.join(additional)
+
+
+class FakeDnsServer:
+    '''
+    Serves canned_response on host over UDP and TCP from daemon
+    threads, on a free port unless one is given
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, loss=0.0, latency=0.0,
+                 seed=1, limit=None):
+        self.host = host
+        self.loss = loss
+        self.latency = latency
+        self.limit = limit
+        self.tokens = limit
+        self.updated = time.monotonic()
+        self.random = random.Random(seed)
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((host, port))
+        self.port = self.udp.getsockname()[1]
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind((host, self.port))
+        self.tcp.listen(64)
+        self.running = False
+        self.received = 0
+        self.dropped = 0
+        self.refused = 0
+
+    def start(self):
+        self.running = True
+        for target in (self.serve_udp, self.serve_tcp):
+            threading.Thread(target=target, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.udp.close()
+        self.tcp.close()
+
+    def serve_udp(self):
+        '''Answers the datagrams, replies wait on a heap for latency'''
+        delayed = []
+        sequence = 0
+        while self.running:
+            timeout = 0.1
+            if delayed:
+                timeout = max(0, delayed[0][0] - time.monotonic())
+            try:
+                readable = select.select([self.udp], [], [], timeout)[0]
+                if readable:
+                    query, addr = self.udp.recvfrom(65535)
+                    self.received += 1
+                    if self.loss and self.random.random() < self.loss:
+                        self.dropped += 1
+                    else:
+                        sequence += 1
+                        heapq.heappush(delayed, (
+                            time.monotonic() + self.latency, sequence,
+                            self.respond(query), addr))
+                now = time.monotonic()
+                while delayed and delayed[0][0] <= now:
+                    _, _, reply, addr = heapq.heappop(delayed)
+                    self.udp.sendto(reply, addr)
+            except (OSError, ValueError, IndexError):
+                if not self.running:
+                    return
+
+    def respond(self, query):
+        '''The canned response, or REFUSED once over the limit'''
+        if self.limit:
+            now = time.monotonic()
+            self.tokens = min(self.limit, self.tokens +
+                              (now - self.updated) * self.limit)
+            self.updated = now
+            if self.tokens < 1:
+                self.refused += 1
+                return refused_response(query)
+            self.tokens -= 1
+        return canned_response(query)
+
+    def serve_tcp(self):
+        while self.running:
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve_connection, args=(conn,),
+                             daemon=True).start()
+
+    def serve_connection(self, conn):
+        # Replies are written one by one, Nagle would hold them back
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = conn.makefile('rb')
+        try:
+            while True:
+                prefix = stream.read(2)
+                if len(prefix) < 2:
+                    break
+                query = stream.read(length_struct.unpack(prefix)[0])
+                self.received += 1
+                if self.latency:
+                    time.sleep(self.latency)
+                reply = canned_response(query, tcp=True)
+                conn.sendall(length_struct.pack(len(reply)) + reply)
+        except (OSError, IndexError):
+            pass
+        finally:
+            stream.close()
+            conn.close()
+
+
+if __name__ == '__main__':
+    print('This is the fake server of the benchmarks, run bench_suite.py')
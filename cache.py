@@ -0,0 +1,257 @@
+import time
+import struct
+from collections import OrderedDict
+import instrument
+from ratelimit import TokenBucket
+from response import DnsResponseBuilder
+from wire import ttl_offsets
+
+ttl_struct = struct.Struct('!L')
+
+
+def age(data, ttl, left):
+    '''
+    Lowers the TTL of every record of the response in data, a
+    bytearray stored for ttl seconds of which left are left, by the
+    seconds gone since, and to no more than left
+    '''
+    elapsed = ttl - left
+    for offset in ttl_offsets(data):
+        record_ttl = ttl_struct.unpack_from(data, offset)[0]
+        ttl_struct.pack_into(data, offset,
+                             int(max(0, min(record_ttl - elapsed, left))))
+
+
+class DnsCache:
+    '''
+    In-process answer cache keyed on (name, qtype, qclass), which the
+    forwarder extends with the EDNS flags of the query.
+    The raw response is stored until the smallest TTL of its answers
+    runs out, NXDOMAIN and NODATA responses are kept for the SOA
+    minimum of the authority section (RFC 2308). When more than
+    max_size entries are stored, the least recently used is evicted.
+
+    With refresh set, an entry hit at least refresh_hits times since
+    it was stored is due to be asked again once less than the fraction
+    refresh of its TTL is left, so that popular names are refreshed
+    before they expire. refresh_due tells the caller, which keeps
+    answering from the entry until the new answer is stored. At most
+    refresh_rate entries per second are refreshed.
+    '''
+
+    def __init__(self, max_size=1024, max_ttl=86400, refresh=0.0,
+                 refresh_hits=2, refresh_rate=10):
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self.refresh = refresh
+        self.refresh_hits = refresh_hits
+        self.refresh_limiter = TokenBucket(refresh_rate)
+        self.refreshing = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+        self.refreshes_skipped = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(builder, packet):
+        '''
+        The key of a query, qtype and qclass are the last
+        4 bytes of the question in the query packet
+        '''
+        qtype, qclass = struct.unpack_from('!HH', packet, builder.length - 4)
+        return (builder.url.lower().rstrip('.'), qtype, qclass)
+
+    def get(self, key, q_id):
+        '''
+        Returns the cached response with its ID replaced by q_id,
+        so that it can be decoded as the answer to the new query, and
+        the TTLs of its records lowered by the time it was kept.
+        None is returned on a miss.
+        '''
+        data = self.lookup(key)
+        if data is None:
+            self.misses += 1
+            if instrument.recorder is not None:
+                instrument.recorder.count('cache misses')
+            return None
+
+        self.hits += 1
+        if instrument.recorder is not None:
+            instrument.recorder.count('cache hits')
+        data = bytearray(data)
+        struct.pack_into('!H', data, 0, q_id)
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[3] += 1
+            age(data, entry[2], entry[1] - time.monotonic())
+        return bytes(data)
+
+    def refresh_due(self, key):
+        '''
+        Whether the caller should ask for key again now, in the
+        background. It is due once per lifetime of the entry, and
+        refresh_done must be called when the query is over.
+        '''
+        if not self.refresh or key in self.refreshing:
+            return False
+        entry = self.entries.get(key)
+        if entry is None or entry[3] < self.refresh_hits or \
+                entry[1] - time.monotonic() > entry[2] * self.refresh:
+            return False
+
+        if self.refresh_limiter.delay() > 0:
+            # Over the cap, a later hit tries again
+            self.refreshes_skipped += 1
+            if instrument.recorder is not None:
+                instrument.recorder.count('prefetches skipped')
+            return False
+        self.refresh_limiter.take()
+        self.refreshing.add(key)
+        self.refreshes += 1
+        if instrument.recorder is not None:
+            instrument.recorder.count('prefetches')
+        return True
+
+    def refresh_done(self, key):
+        '''The refresh of key is over, whether it was stored or not'''
+        self.refreshing.discard(key)
+
+    def lookup(self, key):
+        '''The stored response, None if there is none or it expired'''
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, data, query_length):
+        '''Stores the response if it may be cached'''
+        ttl = self.response_ttl(data, query_length)
+        if ttl is None or ttl <= 0:
+            return
+        self.store(key, data, min(ttl, self.max_ttl))
+
+    def store(self, key, data, ttl, remaining=None):
+        '''
+        Keeps the response for ttl seconds, or the remaining seconds
+        of a ttl that started earlier, as [data, expiry, ttl, hits
+        since stored]
+        '''
+        if remaining is None:
+            remaining = ttl
+        self.entries[key] = [data, time.monotonic() + remaining, ttl, 0]
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def response_ttl(self, data, query_length):
+        '''
+        The number of seconds the response may be cached for,
+        None if it must not be cached at all.
+        '''
+        try:
+            response = DnsResponseBuilder(data, query_length, None, None)
+            response.create_header()
+            header = response.header
+            if header.truncated or header.rcode not in (0, 3):
+                return None
+            if not (header.num_response or header.num_authority or
+                    header.num_additional):
+                return None
+            # Every record is walked again to age it on a hit
+            ttl_offsets(data)
+
+            response.parse()
+            if header.rcode == 0 and header.num_response:
+                return min(record.ttl for record in response.answer_records)
+
+            # Negative answer, the SOA of the zone gives its lifetime
+            for record in response.authority_records:
+                if record.rtype == 6:
+                    return min(record.ttl, record.rdata.minimum)
+
+        except (IndexError, ValueError, struct.error):
+            # Malformed, not worth keeping
+            pass
+
+        return None
+
+    def stats(self):
+        stats = {'size': len(self.entries), 'hits': self.hits,
+                 'misses': self.misses, 'evictions': self.evictions}
+        if self.refresh:
+            stats['prefetches'] = self.refreshes
+            stats['prefetches_skipped'] = self.refreshes_skipped
+        return stats
+
+    def clear(self):
+        self.entries.clear()
+
+
+class DelegationCache:
+    '''
+    Zone cuts learned from referrals, each zone maps to the names and
+    addresses of its nameservers until the smallest TTL of the NS
+    records and glue runs out. The least recently used zone is evicted
+    when more than max_size are stored.
+    '''
+
+    def __init__(self, max_size=1024, max_ttl=86400):
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, zone, names, addresses, ttl):
+        if ttl <= 0 or not addresses:
+            return
+        self.entries[zone] = (tuple(names), tuple(addresses),
+                              time.monotonic() + min(ttl, self.max_ttl))
+        self.entries.move_to_end(zone)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, zone):
+        '''The (names, addresses) of the zone, None if not known'''
+        entry = self.entries.get(zone)
+        if entry is None:
+            return None
+        names, addresses, expires = entry
+        if expires <= time.monotonic():
+            del self.entries[zone]
+            return None
+        self.entries.move_to_end(zone)
+        return names, addresses
+
+    def closest(self, name):
+        '''
+        The deepest known zone that name is in, as (zone, names,
+        addresses), or None if not even a top level zone is known
+        '''
+        labels = name.lower().rstrip('.').split('.')
+        for index in range(len(labels)):
+            zone = '.'.join(labels[index:])
+            entry = self.get(zone)
+            if entry is not None:
+                return (zone,) + entry
+
+        return None
+
+    def clear(self):
+        self.entries.clear()
+
+
+if __name__ == '__main__':
+    print('This is the file for the cache class, run dns.py instead')
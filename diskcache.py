@@ -0,0 +1,350 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+import instrument
+from cache import DnsCache
+
+'''
+Answer cache kept in a file, so that it outlives the process and is
+shared by every process using the same file. The file is:
+
+    header  magic, version, number of slots, end of the data, slots
+            used, bytes of replaced records, and the retired flag
+    index   open addressing hash table of (hash, offset) slots,
+            memory mapped, an offset of 0 being an empty slot
+    data    the records appended one after the other, each one is
+            the absolute expiry time (seconds since the epoch), the
+            TTL it was stored with, the key and the raw response
+
+A lookup hashes the key, probes the index in the mapping and reads
+only the record it points to, the file is never read as a whole.
+Readers hold a shared flock on the file, writers an exclusive one.
+Expired and replaced records stay in the file until it is compacted:
+the live records are copied to a new file, renamed over the old one,
+and the old file is marked retired so that the processes still using
+it open the new one. Clearing puts an empty file in place the same way.
+'''
+
+magic = b'DNSCACHE'
+version = 3
+header_struct = struct.Struct('<8sIIQQQI20x')
+slot_struct = struct.Struct('<QQ')
+record_struct = struct.Struct('<ddHH')
+
+# Slots used, as a fraction of all of them, before compacting
+max_load = 0.7
+
+
+def key_bytes(key):
+    '''
+    The (name, qtype, qclass) key as stored in the file, followed by
+    the flags of the keys of the forwarder, if any
+    '''
+    name, qtype, qclass = key[:3]
+    flags = key[3:]
+    return struct.pack('!HHB', qtype, qclass, len(flags)) + bytes(flags) + \
+        name.encode('utf-8')
+
+
+def key_hash(data):
+    '''A 64 bit hash, the same in every process unlike hash()'''
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          'little')
+
+
+class DiskFile:
+    '''
+    The cache file of one process, locked around every operation.
+    get and put return and take raw responses, with their absolute
+    expiry time and the TTL they were stored with.
+    '''
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.initial_slots = max(16, 1 << (slots - 1).bit_length())
+        self.fd = None
+        self.map = None
+        self.open()
+
+    def open(self):
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            header = os.pread(fd, header_struct.size, 0)
+            if len(header) == header_struct.size and \
+                    header_struct.unpack(header)[6]:
+                # Opened just before a compaction put a new file there
+                os.close(fd)
+                continue
+            break
+
+        try:
+            if len(header) < header_struct.size or \
+                    header_struct.unpack(header)[:2] != (magic, version):
+                # New, or not a cache file this version can read
+                self.initialize(fd, self.initial_slots)
+            self.slots = header_struct.unpack(
+                os.pread(fd, header_struct.size, 0))[2]
+            self.mask = self.slots - 1
+            self.map = mmap.mmap(fd, self.data_start(self.slots))
+            self.fd = fd
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    @staticmethod
+    def data_start(slots):
+        return header_struct.size + slots * slot_struct.size
+
+    def initialize(self, fd, slots):
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, self.data_start(slots))
+        os.pwrite(fd, header_struct.pack(magic, version, slots,
+                                         self.data_start(slots), 0, 0, 0), 0)
+
+    def header(self):
+        return header_struct.unpack_from(self.map, 0)
+
+    def lock(self, operation):
+        '''
+        Takes the flock, opening the file again if it was retired by a
+        compaction while waiting for it
+        '''
+        while True:
+            fcntl.flock(self.fd, operation)
+            if not self.header()[6]:
+                return
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.close()
+            self.open()
+
+    def probe(self, digest, key):
+        '''
+        The index of the slot of key, or of the empty slot it would
+        go in, and the offset of its record, 0 if it is not stored
+        '''
+        index = digest & self.mask
+        for _ in range(self.slots):
+            stored, offset = slot_struct.unpack_from(
+                self.map, header_struct.size + index * slot_struct.size)
+            if offset == 0:
+                return index, 0
+            if stored == digest and self.read_key(offset) == key:
+                return index, offset
+            index = (index + 1) & self.mask
+        return None, 0
+
+    def read_key(self, offset):
+        head = os.pread(self.fd, record_struct.size, offset)
+        if len(head) < record_struct.size:
+            return None
+        _, _, key_length, _ = record_struct.unpack(head)
+        return os.pread(self.fd, key_length, offset + record_struct.size)
+
+    def read(self, offset):
+        '''(expires, ttl, key, data) of the record at offset'''
+        head = os.pread(self.fd, record_struct.size, offset)
+        expires, ttl, key_length, data_length = record_struct.unpack(head)
+        body = os.pread(self.fd, key_length + data_length,
+                        offset + record_struct.size)
+        return expires, ttl, body[:key_length], body[key_length:]
+
+    def get(self, key):
+        '''(data, expires, ttl) of the key, None if missing or expired'''
+        key = key_bytes(key)
+        digest = key_hash(key)
+        self.lock(fcntl.LOCK_SH)
+        try:
+            _, offset = self.probe(digest, key)
+            if not offset or offset >= self.header()[3]:
+                return None
+            expires, ttl, _, data = self.read(offset)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        if expires <= time.time():
+            return None
+        return data, expires, ttl
+
+    def put(self, key, data, expires, ttl):
+        key = key_bytes(key)
+        digest = key_hash(key)
+        self.lock(fcntl.LOCK_EX)
+        try:
+            _, _, slots, end, used, garbage, _ = self.header()
+            if used + 1 > slots * max_load or \
+                    garbage > max(1 << 20, (end - self.data_start(slots)) / 2):
+                self.rewrite()
+                _, _, slots, end, used, garbage, _ = self.header()
+
+            index, offset = self.probe(digest, key)
+            if index is None:
+                return
+            record = record_struct.pack(expires, ttl, len(key),
+                                        len(data)) + key + data
+            os.pwrite(self.fd, record, end)
+            slot_struct.pack_into(self.map, header_struct.size +
+                                  index * slot_struct.size, digest, end)
+            if offset:
+                _, _, old_key, old_data = self.read(offset)
+                garbage += record_struct.size + len(old_key) + len(old_data)
+            else:
+                used += 1
+            header_struct.pack_into(self.map, 0, magic, version, slots,
+                                    end + len(record), used, garbage, 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def records(self):
+        '''Yields (digest, expires, ttl, key, data) of the indexed records'''
+        end = self.header()[3]
+        for index in range(self.slots):
+            digest, offset = slot_struct.unpack_from(
+                self.map, header_struct.size + index * slot_struct.size)
+            if offset and offset < end:
+                yield (digest,) + self.read(offset)
+
+    def compact(self):
+        '''Drops the expired and replaced records from the file'''
+        self.lock(fcntl.LOCK_EX)
+        try:
+            self.rewrite()
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def rewrite(self):
+        '''
+        Writes the records that did not expire to a new file, with
+        twice the slots if they fill more than half of them, and puts
+        it in place of this one. The caller holds the exclusive lock.
+        '''
+        now = time.time()
+        live = [record for record in self.records() if record[1] > now]
+        slots = self.slots
+        while len(live) > slots / 2:
+            slots *= 2
+        self.replace(live, slots)
+
+    def replace(self, live, slots):
+        '''
+        Puts a new file of the given slots, holding the live records,
+        in place of this one, which is retired. The caller holds the
+        exclusive lock, it holds it on the new file on return.
+        '''
+        temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+        fd = os.open(temporary, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            self.initialize(fd, slots)
+            index_map = bytearray(slots * slot_struct.size)
+            chunks = []
+            end = self.data_start(slots)
+            mask = slots - 1
+            for digest, expires, ttl, key, data in live:
+                index = digest & mask
+                while slot_struct.unpack_from(
+                        index_map, index * slot_struct.size)[1]:
+                    index = (index + 1) & mask
+                slot_struct.pack_into(index_map, index * slot_struct.size,
+                                      digest, end)
+                record = record_struct.pack(expires, ttl, len(key),
+                                            len(data)) + key + data
+                chunks.append(record)
+                end += len(record)
+            os.pwrite(fd, b''.join(chunks), self.data_start(slots))
+            os.pwrite(fd, bytes(index_map), header_struct.size)
+            os.pwrite(fd, header_struct.pack(magic, version, slots, end,
+                                             len(live), 0, 0), 0)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temporary, self.path)
+
+        # Processes waiting on the old file open the new one
+        header = list(self.header())
+        header[6] = 1
+        header_struct.pack_into(self.map, 0, *header)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.close()
+        self.open()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def clear(self):
+        '''
+        Empties the cache, with a new file so that the mappings of the
+        other processes are never truncated under them
+        '''
+        self.lock(fcntl.LOCK_EX)
+        try:
+            self.replace([], self.initial_slots)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def __len__(self):
+        return self.header()[4]
+
+
+class DiskCache(DnsCache):
+    '''
+    A DnsCache backed by a cache file, answers missing from memory
+    are looked up in the file, and every answer stored is written to
+    it with its absolute expiry time. Any number of processes can use
+    the same file at once.
+
+    Usage:
+        cache = DiskCache(os.path.expanduser('~/.cache/dns.cache'))
+    '''
+
+    def __init__(self, path, max_size=1024, max_ttl=86400, slots=65536,
+                 refresh=0.0, refresh_hits=2, refresh_rate=10):
+        super().__init__(max_size, max_ttl, refresh, refresh_hits,
+                         refresh_rate)
+        self.file = DiskFile(path, slots)
+        self.disk_hits = 0
+
+    def lookup(self, key):
+        data = super().lookup(key)
+        if data is not None:
+            return data
+
+        stored = self.file.get(key)
+        if stored is None:
+            return None
+        data, expires, ttl = stored
+        self.disk_hits += 1
+        if instrument.recorder is not None:
+            instrument.recorder.count('disk hits')
+        super().store(key, data, ttl, expires - time.time())
+        return data
+
+    def store(self, key, data, ttl):
+        super().store(key, data, ttl)
+        self.file.put(key, data, time.time() + ttl, ttl)
+
+    def stats(self):
+        stats = super().stats()
+        stats['disk_hits'] = self.disk_hits
+        stats['disk_size'] = len(self.file)
+        return stats
+
+    def clear(self):
+        super().clear()
+        self.file.clear()
+
+    def compact(self):
+        self.file.compact()
+
+    def close(self):
+        self.file.close()
+
+
+if __name__ == '__main__':
+    print('This is the file for the persistent cache, run dns.py instead')
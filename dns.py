@@ -1,8 +1,14 @@
-import socket
 import argparse
-from sys import exit
-from response import DnsResponseBuilder
+import os
+import sys
+import time
+import instrument
 from query import DnsQueryBuilder
+from batch import BatchLineError, BatchResolver, read_batch
+from cache import DnsCache
+from transport import TcpConnectionPool, UdpSocketPool, is_truncated
+from servers import ServerSelector, get_nameservers
+from output import Result, TextWriter, make_result, rcode_names, writers
 '''
 https://www.iana.org/assignments/dns-parameters/dns-parameters.xhtml
 Most commonly used types are:
@@ -13,30 +19,39 @@ Most commonly used types are:
 -> TXT
 -> SOA
 -> PTR
+
+Only what a single lookup needs is imported here. The modules of the
+other modes are imported by the functions running them, as asyncio
+and multiprocessing alone take longer to load than a lookup takes.
 '''
 
 # Defining certain global parameters
 port_number = 53
-error_flag = 0
 time_out = 50
-mismatch_error = False
-any_flag = False
+writer = TextWriter(sys.stdout)
+answer_cache = DnsCache()
+use_tcp = False
+buffer_size = 1232
+tcp_pool = TcpConnectionPool()
+udp_pool = UdpSocketPool()
+default_types = ["A", "AAAA"]
+any_types = ["A", "NS", "SOA", "MX", "TXT", "AAAA"]
 list_of_choices = ["A", "NS", "CNAME", "SOA", "PTR", "HINFO",
                    "MINFO", "MX", "TXT", "WKS", "RP", "AFSDB",
                    "X25", "ISDN", "RT", "NSAP", "NSAP-PTR",
                    "SIG", "KEY", "PX", "GPOS", "AAAA", "ANY"]
 
 
-def get_default():
-    dns = open('/etc/resolv.conf')
-
-    for line in dns.readlines():
-        if line != '\n' and line[0] != '#':
-            data = line.split()
-            if data[0] == 'nameserver':
-                return data[1]
-
-    return '127.0.0.53'
+def payload_size(value):
+    '''
+    The --bufsize argument, 0 or a UDP payload size that fits the
+    16 bits of the OPT record
+    '''
+    size = int(value)
+    if size != 0 and not 512 <= size <= 65535:
+        raise argparse.ArgumentTypeError(
+            'must be 0 or from 512 to 65535: {}'.format(value))
+    return size
 
 
 def args_handler():
@@ -47,9 +62,10 @@ def args_handler():
     argparse() module is used for this purpose.
     '''
     p = argparse.ArgumentParser(description='Nslookup by Shabbir and Sushant')
-    p.add_argument('url', help='Enter URl for DNS Query ')
-    p.add_argument('--dns_ip', default=get_default(),
-                   help='IP Adress of DNS Server, eg: --dns_ip=127.0.0.53')
+    p.add_argument('url', nargs='?', help='Enter URl for DNS Query ')
+    p.add_argument('--dns_ip', action='append', default=None,
+                   help='IP Adress of DNS Server, can be repeated, defaults to \
+                   every nameserver in /etc/resolv.conf, eg: --dns_ip=127.0.0.53')
     p.add_argument('--rtype', default="default", choices=list_of_choices,
                    type=str.upper, help='Request Query type, eg: --rtype MX')
     p.add_argument('--port', default=53, help='Port number of the DNS server, \
@@ -58,7 +74,70 @@ def args_handler():
                     eg: --timeout=50')
     p.add_argument('--recurse', default=False, help='Type of query: Recursive and \
                     Non-Recursive eg: --recurse=0')
+    p.add_argument('--batch', default=None, help='File with one URL (and \
+                    optionally its query type) per line, - for stdin, \
+                    eg: --batch=names.txt')
+    p.add_argument('--concurrency', default=100, help='Number of queries kept \
+                    in flight in batch mode, eg: --concurrency=100')
+    p.add_argument('--tcp', default=False, help='Send the queries over TCP \
+                    instead of UDP, eg: --tcp=1')
+    p.add_argument('--bufsize', default=1232, type=payload_size,
+                   help='UDP payload size advertised \
+                    with EDNS(0), 0 disables EDNS, eg: --bufsize=4096')
+    p.add_argument('--race', default=False, help='Also ask the next server \
+                    when the fastest one is late, eg: --race=1')
+    p.add_argument('--iterate', default=False, help='Resolve iteratively \
+                    from the root servers, or from the --dns_ip servers if \
+                    given, following every referral, eg: --iterate=1')
+    p.add_argument('--sweep', default=None, help='Comma separated IPv4 or \
+                    IPv6 blocks to resolve the PTR record of every address \
+                    of, printed as address<TAB>name, eg: --sweep=10.0.0.0/16')
+    p.add_argument('--workers', default=1, help='Number of processes \
+                    resolving the batch file, 0 for one per core, \
+                    eg: --workers=8')
+    p.add_argument('--ordered', default=False, help='Write the answers of \
+                    a batch in the order of the file instead of as they \
+                    arrive, eg: --ordered=1')
+    p.add_argument('--rate', default=0, help='Most new queries sent per \
+                    second in batch and sweep modes, 0 for no limit, \
+                    eg: --rate=500')
+    p.add_argument('--server_rate', default=0, help='Most queries sent \
+                    per second to each server in batch and sweep modes, \
+                    retries included, 0 for no limit, eg: --server_rate=200')
+    p.add_argument('--adaptive', default=False, help='Adapt the number of \
+                    queries in flight, up to --concurrency, cutting it when \
+                    queries time out or get SERVFAIL or REFUSED and growing \
+                    it while they are answered, eg: --adaptive=1')
+    p.add_argument('--serve', default=None, help='Run as a caching \
+                    forwarder on HOST:PORT over UDP and TCP, asking the \
+                    first --dns_ip server on misses, eg: --serve=127.0.0.1:5300')
+    p.add_argument('--format', default='text', choices=sorted(writers),
+                   help='Output format, text as nslookup prints it or a \
+                   row per record in JSON Lines or CSV, eg: --format=jsonl')
+    p.add_argument('--stats', default=False, help='Print the timings of \
+                    each phase of the lookups, with latency histograms, and \
+                    the retry, truncation, cache and rcode counters to stderr \
+                    at the end, eg: --stats=1')
+    p.add_argument('--profile', default=None, help='Run under cProfile and \
+                    save the statistics to a file, - prints them to stderr, \
+                    eg: --profile=dns.prof')
+    p.add_argument('--cache_size', default=1024, help='Number of answers kept \
+                    in the in-process cache, 0 disables it, eg: --cache_size=1024')
+    p.add_argument('--cache_file', default=None, help='File keeping the \
+                    answers between runs, shared by every process using it, \
+                    eg: --cache_file=~/.cache/dns.cache')
+    p.add_argument('--prefetch', default=0, help='In serve mode, ask again \
+                    for a cached answer hit twice or more once less than this \
+                    fraction of its TTL is left, 0 disables it, eg: \
+                    --prefetch=0.1')
+    p.add_argument('--prefetch_rate', default=10, help='Most answers \
+                    prefetched per second, eg: --prefetch_rate=10')
     args = p.parse_args()
+    if args.url is None and args.batch is None and args.serve is None and \
+            args.sweep is None:
+        p.error('either a URL, --batch, --sweep or --serve is required')
+    if args.dns_ip is None and not int(args.iterate):
+        args.dns_ip = get_nameservers()
     # Now, we want to get the responses
     main(args)
 
@@ -73,43 +152,334 @@ def main(args):
     global port_number, time_out
     port_number = int(args.port)
     time_out = int(args.timeout)
-    print('Server: {}'.format(args.dns_ip))
-    print('Address: {}#{}\n'.format(args.dns_ip, port_number))
-    # Encoding the into arguments into byte format for use
+    if int(args.stats):
+        instrument.enable()
+    try:
+        if args.profile is not None:
+            instrument.profiled(run, args.profile, args)
+        else:
+            run(args)
+    finally:
+        if instrument.recorder is not None:
+            print('\n' + instrument.recorder.summary(), file=sys.stderr)
+
+
+def run(args):
+    '''Serves, or looks up and writes the answers in the chosen format'''
+    global writer
+    if args.serve is not None:
+        serve(args)
+        return
+
+    writer = writers[args.format](sys.stdout)
+    try:
+        resolve(args)
+    finally:
+        writer.flush()
+
+
+def resolve(args):
+    '''Prints the servers used, then looks up what the arguments ask'''
+    global answer_cache, use_tcp, buffer_size
+    # Output meant for other tools gets only the answers, so this goes aside
+    out = sys.stdout
+    if args.sweep is not None or args.format != 'text':
+        out = sys.stderr
+    if args.dns_ip is None:
+        from iterative import root_hints
+        print('Server: root hints', file=out)
+        print('Address: {}\n'.format(', '.join(
+            '{}#{}'.format(dns, port_number) for _, dns in root_hints)),
+            file=out)
+    else:
+        print('Server: {}'.format(', '.join(args.dns_ip)), file=out)
+        print('Address: {}\n'.format(', '.join(
+            '{}#{}'.format(dns, port_number) for dns in args.dns_ip)),
+            file=out)
     url = args.url
-    dns = args.dns_ip.encode('utf-8')
-    port_number = int(args.port)
-    time_out = int(args.timeout)
     recurse = int(args.recurse)
-    if args.rtype == 'DEFAULT' and not url[0].isnumeric():
-        rtype = 'A'.encode('utf-8')
-        get_response(url, dns, port_number, rtype, time_out, recurse)
-        rtype = 'AAAA'.encode('utf-8')
-        get_response(url, dns, port_number, rtype, time_out, recurse)
-
-    elif args.rtype == 'ANY' and not url[0].isnumeric():
-        global any_flag
-        any_flag = True
-        rtype = 'A'.encode('utf-8')
-        get_response(url, dns, port_number, rtype, time_out, recurse)
-        rtype = 'NS'.encode('utf-8')
-        get_response(url, dns, port_number, rtype, time_out, recurse)
-        rtype = 'SOA'.encode('utf-8')
-        get_response(url, dns, port_number, rtype, time_out, recurse)
-        rtype = 'MX'.encode('utf-8')
-        get_response(url, dns, port_number, rtype, time_out, recurse)
-        rtype = 'TXT'.encode('utf-8')
-        get_response(url, dns, port_number, rtype, time_out, recurse)
-        rtype = 'AAAA'.encode('utf-8')
-        get_response(url, dns, port_number, rtype, time_out, recurse)
+    use_tcp = bool(int(args.tcp))
+    buffer_size = int(args.bufsize)
+    tcp_pool.timeout = time_out
+    answer_cache = new_cache(args)
+
+    if int(args.iterate):
+        from iterative import IterativeResolver
+        hints = None
+        if args.dns_ip is not None:
+            hints = [(dns, dns) for dns in args.dns_ip]
+        resolver = IterativeResolver(hints, port_number, time_out,
+                                     bufsize=buffer_size, udp_pool=udp_pool,
+                                     tcp_pool=tcp_pool)
+        try:
+            iterate(args, resolver)
+        except BatchLineError as error:
+            print('*** {}'.format(error), file=sys.stderr)
+        return
+
+    # All the servers are asked through one selector, fastest first
+    try:
+        dns = ServerSelector(args.dns_ip, port_number, bool(int(args.race)))
+    except ValueError as error:
+        print('*** {}'.format(error), file=sys.stderr)
+        return
+    if args.sweep is not None:
+        sweep(args, dns, port_number, time_out, recurse)
+
+    elif args.batch is not None:
+        try:
+            if int(args.workers) != 1 or int(args.ordered):
+                shard(args, dns, port_number, time_out, recurse)
+            else:
+                batch(args, dns, port_number, time_out, recurse)
+        except BatchLineError as error:
+            print('*** {}'.format(error), file=sys.stderr)
+
+    elif args.rtype == 'DEFAULT' and not is_address(url):
+        fan_out(url, dns, port_number, default_types, time_out, recurse)
+
+    elif args.rtype == 'ANY' and not is_address(url):
+        writer.any_mode = True
+        fan_out(url, dns, port_number, any_types, time_out, recurse)
 
     else:
         rtype = args.rtype.encode('utf-8')
+        if args.rtype in ('DEFAULT', 'ANY'):
+            # An address, its PTR record is all there is to ask
+            rtype = b'PTR'
         # Then we obtain data regarding the the requested URL.
-        get_response(url, dns, port_number, rtype, time_out, recurse)
+        get_response(url, dns, port_number, rtype, time_out, recurse,
+                     use_tcp)
+
 
+def is_address(url):
+    '''
+    Whether the URL is an IPv4 or IPv6 address, which is looked up
+    with a single PTR query whatever the type asked for
+    '''
+    if url[:1].isnumeric():
+        return True
+    if ':' not in url:
+        return False
+    import ipaddress
+    try:
+        ipaddress.IPv6Address(url)
+    except ValueError:
+        return False
+    return True
 
-def get_response(url, dns, port=53, rtype='A', timeout=50, recurse=False):
+
+def cache_path(args):
+    if args.cache_file is None:
+        return None
+    return os.path.expanduser(args.cache_file)
+
+
+def new_cache(args):
+    '''
+    The answer cache the arguments ask for, kept in --cache_file if
+    given, None if caching is disabled
+    '''
+    refresh = float(args.prefetch)
+    refresh_rate = float(args.prefetch_rate)
+    if args.cache_file is not None:
+        from diskcache import DiskCache
+        return DiskCache(cache_path(args), int(args.cache_size),
+                         refresh=refresh, refresh_rate=refresh_rate)
+    if int(args.cache_size) > 0:
+        return DnsCache(int(args.cache_size), refresh=refresh,
+                        refresh_rate=refresh_rate)
+    return None
+
+
+def serve(args):
+    '''
+    Runs the caching forwarder until it is interrupted, then prints
+    the statistics of its cache
+    '''
+    import asyncio
+    from aioresolver import AsyncResolver
+    from forwarder import DnsForwarder, parse_address
+    host, port = parse_address(args.serve)
+    try:
+        upstream = AsyncResolver(args.dns_ip, port_number, time_out,
+                                 recurse=True, tcp=bool(int(args.tcp)),
+                                 bufsize=int(args.bufsize))
+    except ValueError as error:
+        print('*** {}'.format(error), file=sys.stderr)
+        return
+    cache = new_cache(args)
+    if cache is None:
+        cache = DnsCache(0)
+    forwarder = DnsForwarder(upstream, host, port, cache)
+    print('Serving on {}#{} over UDP and TCP'.format(host, port))
+    print('Forwarding to {}#{}\n'.format(*upstream.server))
+    try:
+        asyncio.run(forwarder.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+    print(', '.join('{}: {}'.format(name, value)
+                    for name, value in forwarder.stats().items()))
+
+
+def fan_out(url, dns, port, rtypes, timeout=50, recurse=False):
+    '''
+    Sends the queries for all the rtypes at once over one socket,
+    so that they cost a single round trip. The answers are still
+    printed in the order of rtypes, each one as soon as it and all
+    of the ones before it have arrived.
+    '''
+    items = [(url, rtype.encode('utf-8')) for rtype in rtypes]
+    resolver = BatchResolver(dns, port, len(items), timeout, recurse,
+                             answer_cache, use_tcp, tcp_pool, buffer_size,
+                             udp_pool)
+    results = {}
+    index = 0
+    for _, rtype, builder, data, server, rtt in resolver.resolve(items):
+        results[rtype] = (builder, data, server, rtt)
+        while index < len(items) and items[index][1] in results:
+            rtype = items[index][1]
+            builder, data, server, rtt = results[rtype]
+            if not isinstance(data, bytes):
+                print_failure(url, rtype, data)
+            else:
+                decode_response(data, builder.length, builder.url,
+                                builder.q_id, rtype, server, rtt)
+            index += 1
+
+
+def batch(args, dns, port=53, timeout=50, recurse=False):
+    '''
+    Resolves every URL listed in the batch file over one socket and
+    prints the answers in the order in which they arrive.
+    '''
+    resolver = BatchResolver(dns, port, int(args.concurrency), timeout,
+                             recurse, answer_cache, use_tcp, tcp_pool,
+                             buffer_size, udp_pool, float(args.rate),
+                             server_rate=float(args.server_rate),
+                             adaptive=bool(int(args.adaptive)))
+    for url, rtype, builder, data, server, rtt in \
+            resolver.resolve(batch_items(args)):
+        if not isinstance(data, bytes):
+            print_failure(url, rtype, data)
+        else:
+            decode_response(data, builder.length, builder.url,
+                            builder.q_id, rtype, server, rtt)
+
+
+def shard(args, dns, port=53, timeout=50, recurse=False):
+    '''
+    Resolves the batch file in --workers processes, which parse and
+    format the answers too, and writes their output as it comes back,
+    or in the order of the file with --ordered.
+    '''
+    from shard import ShardedResolver
+    resolver = ShardedResolver(dns, port, int(args.workers),
+                               int(args.concurrency), timeout, recurse,
+                               use_tcp, buffer_size, int(args.cache_size),
+                               bool(int(args.race)), float(args.rate),
+                               args.format, bool(int(args.ordered)),
+                               server_rate=float(args.server_rate),
+                               adaptive=bool(int(args.adaptive)),
+                               cache_file=cache_path(args))
+    for text in resolver.resolve(batch_items(args)):
+        writer.stream.write(text)
+
+
+def sweep(args, dns, port=53, timeout=50, recurse=False):
+    '''
+    Resolves the PTR record of every address of the --sweep blocks and
+    writes an address<TAB>name line per name as the answers arrive.
+    Addresses without a name are left out, failures go to stderr.
+    The answers are not cached, as no address is asked twice.
+    With --format=jsonl or csv every answer and failure is written
+    as a Result instead.
+    '''
+    from sweep import ptr_names, sweep_addresses
+    items = ((address, b'PTR')
+             for address in sweep_addresses(args.sweep.split(',')))
+    resolver = BatchResolver(dns, port, int(args.concurrency), timeout,
+                             recurse, None, use_tcp, tcp_pool, buffer_size,
+                             udp_pool, float(args.rate),
+                             server_rate=float(args.server_rate),
+                             adaptive=bool(int(args.adaptive)))
+    for address, rtype, builder, data, server, rtt in resolver.resolve(items):
+        if not isinstance(writer, TextWriter):
+            if not isinstance(data, bytes):
+                print_failure(address, rtype, data)
+            else:
+                decode_response(data, builder.length, builder.url,
+                                builder.q_id, rtype, server, rtt)
+            continue
+        if not isinstance(data, bytes):
+            sys.stderr.write('{}\t*** {}\n'.format(
+                address, data or 'Connection Timed Out'))
+            continue
+        try:
+            names = ptr_names(data)
+        except (IndexError, ValueError) as error:
+            sys.stderr.write('{}\t*** {}\n'.format(address, error))
+            continue
+        for name in names:
+            sys.stdout.write('{}\t{}\n'.format(address, name))
+
+
+def batch_items(args):
+    '''The (url, rtype) pairs of the batch file, rtype in bytes'''
+    default_rtype = 'A' if args.rtype == 'DEFAULT' else args.rtype
+    if args.batch == '-':
+        stream = sys.stdin
+    else:
+        stream = open(args.batch)
+
+    try:
+        for url, rtype in read_batch(stream, default_rtype,
+                                     list_of_choices):
+            yield url, rtype.encode('utf-8')
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def iterate(args, resolver):
+    '''
+    Resolves the URL, or every URL of the batch file, one query at
+    a time by following the referrals from the root. The servers
+    asked are printed before each answer.
+    '''
+    if args.batch is not None:
+        items = batch_items(args)
+    elif args.rtype == 'DEFAULT' and not is_address(args.url):
+        items = [(args.url, rtype.encode('utf-8'))
+                 for rtype in default_types]
+    elif args.rtype == 'ANY' and not is_address(args.url):
+        writer.any_mode = True
+        items = [(args.url, rtype.encode('utf-8')) for rtype in any_types]
+    else:
+        items = [(args.url, args.rtype.encode('utf-8'))]
+
+    for url, rtype in items:
+        started = time.monotonic()
+        try:
+            data, builder, trail = resolver.resolve(url, rtype)
+        except (OSError, ValueError) as error:
+            print_failure(url, rtype, error)
+            continue
+        except IndexError as error:
+            # A referral cut short, skip_record reads past its end
+            print_failure(url, rtype, 'Malformed response: {}'.format(error))
+            continue
+
+        for zone, server in trail:
+            writer.note('Asked {}#{} for zone {}'.format(
+                server[0], server[1], zone + '.' if zone else '.'))
+        decode_response(data, builder.length, builder.url, builder.q_id,
+                        rtype, trail[-1][1], time.monotonic() - started)
+
+
+def get_response(url, dns, port=53, rtype='A', timeout=50, recurse=False,
+                 tcp=False):
     '''
     Main function to get the response and
     format it into required format
@@ -117,84 +487,89 @@ def get_response(url, dns, port=53, rtype='A', timeout=50, recurse=False):
         The url
         The dns server to connect
         The Port number of the Dns server
+    The query goes over TCP if tcp is set, or if the UDP answer
+    is truncated. dns is a server, a list of servers or a
+    ServerSelector, the fastest one answering is used.
     '''
-    builder = DnsQueryBuilder()
+    recorder = instrument.recorder
+    if recorder is not None:
+        started = instrument.clock()
+    if not isinstance(dns, ServerSelector):
+        dns = ServerSelector(dns, port)
+    builder = DnsQueryBuilder(buffer_size)
     packet = builder.build_query_packet(url, rtype, recurse)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('', 8888))
+    if answer_cache is not None:
+        key = answer_cache.key(builder, packet)
+        data = answer_cache.get(key, builder.q_id)
+        if data is not None:
+            decode_response(data, builder.length, builder.url, builder.q_id,
+                            rtype)
+            if recorder is not None:
+                recorder.timing('lookup', instrument.clock() - started)
+            return
 
+    sent = time.monotonic()
     try:
-        sock.settimeout(timeout)
-
-    except Exception:
-        global error_flag
-        if error_flag == 0:
-            error_flag = 1
-            print('Connection Timed Out')
-            exit()
-
-    sock.sendto(bytes(packet), (dns, port))
-    data, addr = sock.recvfrom(1024)
-    decode_response(data, builder.length, builder.url, builder.q_id, rtype)
-    sock.close()
+        if tcp:
+            server = dns.best()
+            data = tcp_pool.exchange(server, packet)
 
+        else:
+            data, server = dns.exchange(udp_pool, packet, timeout,
+                                        max(buffer_size, 512))
+            if is_truncated(data):
+                if recorder is not None:
+                    recorder.count('truncated')
+                data = tcp_pool.exchange(server, packet)
 
-def decode_response(data, length, url, q_id, rtype):
+    except OSError as error:
+        print_failure(url, rtype, error)
+        if recorder is not None:
+            recorder.timing('lookup', instrument.clock() - started)
+        return
 
-    response = DnsResponseBuilder(data, length, url, q_id)
-    response.create_header()
-    response.error_check()
-    if response.is_valid:
+    rtt = time.monotonic() - sent
+    if answer_cache is not None:
+        answer_cache.put(key, data, builder.length)
+    decode_response(data, builder.length, builder.url, builder.q_id, rtype,
+                    server, rtt)
+    if recorder is not None:
+        recorder.timing('lookup', instrument.clock() - started)
 
-        if (response.header['num_response'] == 0 and response.header['num_authority'] == 0):
-            print('Non-authoritative answer:')
-            print("*** Can't find {}: No answer\n".format(response.url))
-            print('Authoritative answers can be found from here\n')
 
-        else:
-            response.parse()
-            response.decode_response()
-            mismatch(rtype, q_id)
-            global any_flag
-            if not any_flag:
-                if (response.qtype == 1 or response.qtype == 28) and not mismatch_error:
-                    print('Non-authoritative answer:')
-                    print(response.answer)
-
-                else:
-                    if not response.header['auth_ans']:
-                        print('Non-authoritative answer:')
-                        if response.header['num_response']:
-                            print(response.answer)
-
-                        else:
-                            print("*** Can't find {}: No answer\n".format(response.url))
-                        print('Authoritative answers can be found from here')
-                        if response.header['num_authority']:
-                            print(response.answer)
-                        elif response.header['num_additional'] != 0:
-                            print(response.additional)
-                        else:
-                            print('\n')
-                    else:
-                        print('Authoritative answers can be found from here\n')
-                        print(response.answer)
-            else:
-                print(response.answer)
+def print_failure(url, rtype, error=None):
+    '''
+    Writes a query that got no answer, error is the QueryTimeout
+    or the OSError it failed with
+    '''
+    if error is None or str(error) == '':
+        error = 'Connection Timed Out'
+    if instrument.recorder is not None:
+        instrument.recorder.count('failed')
+    writer.write(Result(url, rtype, error=str(error)))
 
-    else:
-        if response.error[0] == -1:
-            print(response.error[1] + '\n')
-        else:
-            print('Error No.: {}\n{}'.format(
-                response.error[0], response.error[1]))
 
+def decode_response(data, length, url, q_id, rtype, server=None, rtt=None):
+    '''
+    Writes the answer in data, server is the (address, port) it came
+    from and rtt the seconds it took, None for cached answers
+    '''
+    recorder = instrument.recorder
+    if recorder is None:
+        writer.write(make_result(data, length, url, q_id, rtype, server, rtt))
+        return
 
-def mismatch(typeofquery, typeofresponse):
-    global mismatch_error
-    if typeofquery == 28 and typeofresponse == 28:
-        mismatch_error = True
-    mismatch_error = False
+    if rtt is not None:
+        recorder.timing('exchange', rtt)
+    started = instrument.clock()
+    result = make_result(data, length, url, q_id, rtype, server, rtt)
+    decoded = instrument.clock()
+    writer.write(result)
+    recorder.timing('decode', decoded - started)
+    recorder.timing('format', instrument.clock() - decoded)
+    rcode = result.rcode
+    if rcode is not None:
+        recorder.count('rcode ' + rcode_names.get(rcode, str(rcode)))
 
 
 if __name__ == "__main__":
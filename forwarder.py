@@ -0,0 +1,244 @@
+import asyncio
+import struct
+from cache import DnsCache
+from transport import frame, length_struct
+from wire import WireParser
+
+'''
+Local stub server answering over UDP and TCP from a DnsCache, the
+misses are forwarded to one upstream server through an AsyncResolver.
+Answers are cached apart for queries with and without EDNS, and with
+and without the DO bit, so each client gets what it asked for.
+Clients asking the same question while it is being forwarded all
+wait for the one upstream query. With a cache having refresh set,
+the popular answers are forwarded again shortly before they expire,
+while the clients are still answered from the cache.
+'''
+
+header_struct = struct.Struct('!HHHHHH')
+
+
+def reply_header(data, rcode=0, truncated=False, questions=0):
+    '''
+    The header of a reply to the query in data, keeping its ID,
+    opcode and RD bit and setting QR and RA
+    '''
+    q_id, flags = struct.unpack_from('!HH', data, 0)
+    flags = 32768 | (flags & 30976) | 128 | rcode
+    if truncated:
+        flags |= 512
+    return header_struct.pack(q_id, flags, questions, 0, 0, 0)
+
+
+def error_reply(data, rcode, question_end=None):
+    '''A reply with no records, echoing the question if it was read'''
+    if question_end is None:
+        return reply_header(data, rcode)
+    return reply_header(data, rcode, questions=1) + data[12:question_end]
+
+
+def truncated_reply(data, question_end):
+    '''An empty reply with TC set, for answers too big for a datagram'''
+    return reply_header(data, truncated=True, questions=1) + \
+        data[12:question_end]
+
+
+class DnsForwarder(asyncio.DatagramProtocol):
+    '''
+    Caching forwarder listening on host and port over UDP and TCP.
+    Answers over UDP that are bigger than the payload size of the
+    client (512 bytes without EDNS) are sent back truncated, so that
+    the client asks again over TCP.
+
+    Usage:
+        forwarder = DnsForwarder(AsyncResolver('1.1.1.1'), port=5300)
+        asyncio.run(forwarder.serve_forever())
+    '''
+
+    def __init__(self, upstream, host='127.0.0.1', port=53, cache=None):
+        self.upstream = upstream
+        self.host = host
+        self.port = port
+        if cache is None:
+            cache = DnsCache()
+        self.cache = cache
+        self.inflight = {}
+        self.transport = None
+        self.tcp_server = None
+        self.forwarded = 0
+        self.coalesced = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await self.upstream.open()
+        await loop.create_datagram_endpoint(
+            lambda: self, local_addr=(self.host, self.port))
+        self.tcp_server = await asyncio.start_server(
+            self.handle_tcp, self.host, self.port)
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.tcp_server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+            self.tcp_server = None
+        self.upstream.close()
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['forwarded'] = self.forwarded
+        stats['coalesced'] = self.coalesced
+        return stats
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        asyncio.get_running_loop().create_task(self.reply_udp(data, addr))
+
+    async def reply_udp(self, data, addr):
+        reply = await self.answer(data, udp=True)
+        if reply is not None and self.transport is not None:
+            self.transport.sendto(reply, addr)
+
+    async def handle_tcp(self, reader, writer):
+        '''
+        Answers every query of the connection, the queries are handled
+        side by side so the answers may come back in any order
+        '''
+        tasks = set()
+        try:
+            while True:
+                length = length_struct.unpack(await reader.readexactly(2))[0]
+                data = await reader.readexactly(length)
+                task = asyncio.get_running_loop().create_task(
+                    self.reply_tcp(data, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
+
+    async def reply_tcp(self, data, writer):
+        reply = await self.answer(data)
+        if reply is not None and not writer.is_closing():
+            writer.write(frame(reply))
+
+    async def answer(self, data, udp=False):
+        '''
+        The reply to the query in data, None if it should be dropped.
+        Only standard queries with one question are answered.
+        '''
+        if len(data) < 12:
+            return None
+        try:
+            parser = WireParser(data)
+            header = parser.read_header()
+            if header.is_query:
+                # A response, not a query
+                return None
+            if header.opcode != 0:
+                return error_reply(data, 4)
+            if header.num_queries != 1:
+                return error_reply(data, 1)
+            question = parser.read_questions()[0]
+            question_end = parser.question_end()
+            opt = parser.read_opt() if header.num_additional else None
+        except (IndexError, ValueError, struct.error):
+            return error_reply(data, 1)
+
+        # The answer carries the EDNS of the query sent upstream, and the
+        # DNSSEC records only if it had the DO bit
+        key = (question.name.lower().rstrip('.'), question.qtype,
+               question.qclass, opt is not None,
+               opt is not None and opt.rdata.dnssec_ok)
+        reply = self.cache.get(key, header.identification)
+        if reply is not None:
+            if self.cache.refresh_due(key):
+                self.refresh(key, data, question_end)
+        else:
+            try:
+                reply = await self.forward(key, data, question_end)
+            except (OSError, RuntimeError):
+                return error_reply(data, 2, question_end)
+            reply = data[:2] + reply[2:]
+
+        if udp:
+            size = 512
+            if opt is not None:
+                size = max(size, opt.rdata.payload_size)
+            if len(reply) > size:
+                return truncated_reply(data, question_end)
+        return reply
+
+    async def forward(self, key, data, question_end):
+        '''
+        The upstream answer to the question, a question that is
+        already being forwarded waits for that query instead
+        '''
+        task = self.inflight.get(key)
+        if task is None:
+            self.forwarded += 1
+            task = self.spawn(key, data, question_end)
+        else:
+            self.coalesced += 1
+
+        # Shielded, so a client going away does not cancel the others
+        return await asyncio.shield(task)
+
+    def spawn(self, key, data, question_end):
+        task = asyncio.get_running_loop().create_task(
+            self.ask_upstream(key, data, question_end))
+        self.inflight[key] = task
+        task.add_done_callback(lambda _: self.done(key, task))
+        return task
+
+    def refresh(self, key, data, question_end):
+        '''
+        Forwards the query in data again without waiting for it, the
+        answer replaces the cached one when it arrives
+        '''
+        if key in self.inflight:
+            self.cache.refresh_done(key)
+            return
+        task = self.spawn(key, data, question_end)
+        task.add_done_callback(lambda _: self.refresh_over(key, task))
+
+    def refresh_over(self, key, task):
+        self.cache.refresh_done(key)
+        if not task.cancelled():
+            # Failures only leave the cached answer to expire
+            task.exception()
+
+    def done(self, key, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+
+    async def ask_upstream(self, key, data, question_end):
+        reply = await self.upstream.exchange(data)
+        self.cache.put(key, reply, question_end)
+        return reply
+
+
+def parse_address(address, port=53):
+    '''Splits HOST:PORT, either part may be left out'''
+    host, _, number = str(address).rpartition(':')
+    if not number.isdigit():
+        host, number = address, port
+    return host or '127.0.0.1', int(number)
+
+
+if __name__ == '__main__':
+    print('This is the file for the forwarder, run dns.py instead')
@@ -0,0 +1,245 @@
+import sys
+import time
+
+'''
+Timings of the phases of each lookup and counters of what happened to
+them. The hot paths check the module global recorder, which is None
+unless enable was called, so there is nothing to pay when disabled:
+
+    if instrument.recorder is not None:
+        instrument.recorder.timing('parse', seconds)
+
+Phases timed:
+    socket         creating and binding a UDP socket of the pool
+    connect        opening a TCP connection
+    exchange       sending the query until the answer arrived, retries
+                   included
+    create_header  reading the header of a response
+    parse          splitting a response into its sections
+    decode         checking and parsing an answer into a Result
+    format         writing a Result out
+    lookup         a whole lookup of get_response
+
+Counters: retries, failovers, truncated, cache hits, cache misses, disk
+hits, prefetches, prefetches skipped and rcode NOERROR, rcode NXDOMAIN,
+... of every answer written.
+Gauges keep the last, lowest and highest value of a level, like the
+window of queries in flight of the adaptive batch mode.
+'''
+
+recorder = None
+
+clock = time.perf_counter
+
+
+class Histogram:
+    '''
+    Durations counted in buckets of powers of two microseconds, so
+    that it takes the same memory whatever the number of samples.
+    Quantiles are the upper bound of the bucket they fall in.
+    '''
+    __slots__ = ('buckets', 'count', 'total', 'low', 'high')
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.low = None
+        self.high = None
+
+    def add(self, seconds):
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.low is None or seconds < self.low:
+            self.low = seconds
+        if self.high is None or seconds > self.high:
+            self.high = seconds
+
+    @staticmethod
+    def bound(bucket):
+        '''The upper bound of a bucket in seconds'''
+        return (1 << bucket) / 1e6
+
+    def quantile(self, fraction):
+        if not self.count:
+            return None
+        rank = max(1, int(fraction * self.count + 0.999999))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.bound(bucket), self.high)
+        return self.high
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def export(self):
+        '''The histogram as plain values, to send to another process'''
+        return (self.buckets, self.count, self.total, self.low, self.high)
+
+    def merge(self, exported):
+        '''Adds the samples of an exported histogram to this one'''
+        buckets, count, total, low, high = exported
+        for bucket, number in buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + number
+        self.count += count
+        self.total += total
+        if low is not None and (self.low is None or low < self.low):
+            self.low = low
+        if high is not None and (self.high is None or high > self.high):
+            self.high = high
+
+    def render(self, width=30):
+        '''One line per bucket, from the fastest to the slowest'''
+        most = max(self.buckets.values())
+        lines = []
+        for bucket in range(min(self.buckets), max(self.buckets) + 1):
+            number = self.buckets.get(bucket, 0)
+            lines.append('    <{:>10} {:<{}} {}'.format(
+                format_seconds(self.bound(bucket)),
+                '#' * -(-number * width // most), width, number))
+        return lines
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    if seconds < 1e-3:
+        return '{:.0f}us'.format(seconds * 1e6)
+    if seconds < 1:
+        return '{:.2f}ms'.format(seconds * 1e3)
+    return '{:.2f}s'.format(seconds)
+
+
+class Recorder:
+    '''
+    Collects the timings into a Histogram per phase, the counters and
+    the gauges. Every listener added is also called as
+    listener(kind, name, value) for each event, kind being 'timing',
+    'count' or 'gauge', eg. to send them on to a metrics system.
+    '''
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.gauges = {}
+        self.listeners = []
+
+    def listen(self, listener):
+        self.listeners.append(listener)
+        return listener
+
+    def timing(self, phase, seconds):
+        histogram = self.timings.get(phase)
+        if histogram is None:
+            histogram = self.timings[phase] = Histogram()
+        histogram.add(seconds)
+        for listener in self.listeners:
+            listener('timing', phase, seconds)
+
+    def count(self, name, number=1):
+        self.counters[name] = self.counters.get(name, 0) + number
+        for listener in self.listeners:
+            listener('count', name, number)
+
+    def gauge(self, name, value):
+        '''Sets a level, keeping the lowest and highest it has been'''
+        levels = self.gauges.get(name)
+        if levels is None:
+            self.gauges[name] = [value, value, value]
+        else:
+            levels[0] = value
+            levels[1] = min(levels[1], value)
+            levels[2] = max(levels[2], value)
+        for listener in self.listeners:
+            listener('gauge', name, value)
+
+    def export(self):
+        '''
+        The timings, counters and gauges as plain values, eg. for a
+        worker process to send them to the parent, which merges them
+        '''
+        return {'timings': {phase: histogram.export()
+                            for phase, histogram in self.timings.items()},
+                'counters': dict(self.counters),
+                'gauges': {name: list(levels)
+                           for name, levels in self.gauges.items()}}
+
+    def merge(self, exported):
+        '''Adds what another Recorder exported, without the listeners'''
+        for phase, histogram in exported['timings'].items():
+            if phase not in self.timings:
+                self.timings[phase] = Histogram()
+            self.timings[phase].merge(histogram)
+        for name, number in exported['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + number
+        for name, (value, low, high) in exported['gauges'].items():
+            levels = self.gauges.get(name)
+            if levels is None:
+                self.gauges[name] = [value, low, high]
+            else:
+                self.gauges[name] = [value, min(levels[1], low),
+                                     max(levels[2], high)]
+
+    def summary(self, histograms=True):
+        '''The statistics as text, a table of the phases then counters'''
+        lines = ['{:<14}{:>8}{:>10}{:>10}{:>10}{:>10}'.format(
+            'phase', 'count', 'mean', 'p50', 'p99', 'max')]
+        for phase, histogram in self.timings.items():
+            lines.append('{:<14}{:>8}{:>10}{:>10}{:>10}{:>10}'.format(
+                phase, histogram.count, format_seconds(histogram.mean()),
+                format_seconds(histogram.quantile(0.5)),
+                format_seconds(histogram.quantile(0.99)),
+                format_seconds(histogram.high)))
+        if histograms:
+            for phase in ('exchange', 'lookup'):
+                if phase in self.timings:
+                    lines.append('{} latency:'.format(phase))
+                    lines.extend(self.timings[phase].render())
+        if self.counters:
+            lines.append(', '.join('{}: {}'.format(name, value)
+                                   for name, value in
+                                   sorted(self.counters.items())))
+        for name, (value, low, high) in sorted(self.gauges.items()):
+            lines.append('{}: {} (lowest {}, highest {})'.format(
+                name, value, low, high))
+        return '\n'.join(lines)
+
+
+def enable(new=None):
+    '''Starts recording into new, or a new Recorder, and returns it'''
+    global recorder
+    recorder = new if new is not None else Recorder()
+    return recorder
+
+
+def disable():
+    global recorder
+    recorder = None
+
+
+def profiled(func, path=None, *args, **kwargs):
+    '''
+    Runs func under cProfile. The statistics are saved to path for
+    pstats or snakeviz, or the 25 most costly calls are printed to
+    stderr if path is None or -.
+    '''
+    # Imported here, they take longer to load than the rest of dns.py
+    import cProfile
+    import pstats
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        if path is None or path == '-':
+            pstats.Stats(profile, stream=sys.stderr).sort_stats(
+                'cumulative').print_stats(25)
+        else:
+            profile.dump_stats(path)
+
+
+if __name__ == '__main__':
+    print('This is the file for the instrumentation, run dns.py instead')
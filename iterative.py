@@ -0,0 +1,190 @@
+import instrument
+from cache import DelegationCache
+from query import DnsQueryBuilder
+from servers import ServerSelector
+from transport import TcpConnectionPool, UdpSocketPool, is_truncated
+from wire import WireParser
+
+'''
+Iterative resolution (RFC 1034 section 5.3.3): the query is sent
+without the RD bit, starting at the root servers, and every referral
+is followed to the nameservers of the zone it names until one of them
+answers. The zone cuts learned on the way are kept in a
+DelegationCache, so later lookups start at the closest known zone.
+'''
+
+# IPv4 addresses of the root servers, from the IANA root hints file
+root_hints = [
+    ('a.root-servers.net', '198.41.0.4'),
+    ('b.root-servers.net', '170.247.170.2'),
+    ('c.root-servers.net', '192.33.4.12'),
+    ('d.root-servers.net', '199.7.91.13'),
+    ('e.root-servers.net', '192.203.230.10'),
+    ('f.root-servers.net', '192.5.5.241'),
+    ('g.root-servers.net', '192.112.36.4'),
+    ('h.root-servers.net', '198.97.190.53'),
+    ('i.root-servers.net', '192.36.148.17'),
+    ('j.root-servers.net', '192.58.128.30'),
+    ('k.root-servers.net', '193.0.14.129'),
+    ('l.root-servers.net', '199.7.83.42'),
+    ('m.root-servers.net', '202.12.27.33'),
+]
+
+
+def in_zone(name, zone):
+    '''Whether name is zone itself or below it, '' being the root'''
+    return zone == '' or name == zone or name.endswith('.' + zone)
+
+
+class Referral:
+    '''The zone cut a response delegates to, and its nameservers'''
+    __slots__ = ('zone', 'names', 'addresses', 'ttl')
+
+    def __init__(self, zone, names, addresses, ttl):
+        self.zone = zone
+        self.names = names
+        self.addresses = addresses
+        self.ttl = ttl
+
+
+class IterativeResolver:
+    '''
+    Resolves names by following referrals from the root hints.
+    hints are the (name, address) pairs of the servers to start from,
+    the root servers by default. Only glue for the zone being left is
+    trusted, nameservers without glue are looked up themselves, at
+    most max_depth lookups deep. resolve returns the final response
+    and the trail of (zone, server) pairs that were asked.
+    '''
+
+    def __init__(self, hints=None, port=53, timeout=5, delegations=None,
+                 bufsize=1232, udp_pool=None, tcp_pool=None,
+                 max_referrals=30, max_depth=4):
+        if hints is None:
+            hints = root_hints
+        self.hints = list(hints)
+        self.port = port
+        self.timeout = timeout
+        if delegations is None:
+            delegations = DelegationCache()
+        self.delegations = delegations
+        self.bufsize = bufsize
+        if udp_pool is None:
+            udp_pool = UdpSocketPool()
+        self.udp_pool = udp_pool
+        if tcp_pool is None:
+            tcp_pool = TcpConnectionPool(timeout)
+        self.tcp_pool = tcp_pool
+        self.max_referrals = max_referrals
+        self.max_depth = max_depth
+        self.selectors = {}
+
+    def selector(self, addresses):
+        '''One ServerSelector per nameserver set, so RTTs carry over'''
+        key = tuple(sorted(addresses))
+        selector = self.selectors.get(key)
+        if selector is None:
+            selector = ServerSelector(key, self.port)
+            self.selectors[key] = selector
+        return selector
+
+    def closest(self, name):
+        '''The zone to start at and the addresses of its nameservers'''
+        known = self.delegations.closest(name)
+        if known is not None:
+            return known[0], known[2]
+        return '', [address for _, address in self.hints]
+
+    def resolve(self, url, rtype='A', depth=0):
+        '''
+        Returns (data, builder, trail) where data is the response of
+        the first server that did not refer the query elsewhere.
+        Raises QueryTimeout if the servers of a zone do not answer and
+        ValueError if there are too many referrals.
+        '''
+        builder = DnsQueryBuilder(self.bufsize)
+        packet = builder.build_query_packet(url, rtype, False)
+        name = builder.url.lower().rstrip('.')
+        zone, addresses = self.closest(name)
+        trail = []
+
+        for _ in range(self.max_referrals):
+            data, server = self.selector(addresses).exchange(
+                self.udp_pool, packet, self.timeout, max(self.bufsize, 512))
+            if is_truncated(data):
+                if instrument.recorder is not None:
+                    instrument.recorder.count('truncated')
+                data = self.tcp_pool.exchange(server, packet)
+            trail.append((zone, server))
+
+            referral = self.referral(data, name, zone)
+            if referral is None:
+                return data, builder, trail
+            if not referral.addresses and depth < self.max_depth:
+                referral.addresses = self.lookup(referral.names, depth + 1)
+            if not referral.addresses:
+                # Nowhere to go, the referral is the best answer there is
+                return data, builder, trail
+
+            self.delegations.put(referral.zone, referral.names,
+                                 referral.addresses, referral.ttl)
+            zone, addresses = referral.zone, referral.addresses
+
+        raise ValueError('Too many referrals for {}'.format(url))
+
+    def referral(self, data, name, zone):
+        '''
+        The Referral of a response that delegates name to a zone below
+        the current one, None for any other response
+        '''
+        message = WireParser(data).parse()
+        if message.header.rcode != 0 or message.answer:
+            return None
+
+        cut = None
+        names = []
+        ttl = None
+        for record in message.authority:
+            if record.rtype != 2:
+                continue
+            owner = record.name.lower()
+            if owner == zone or not in_zone(owner, zone) or \
+                    not in_zone(name, owner):
+                continue
+            if cut is None:
+                cut = owner
+            if owner == cut:
+                names.append(record.rdata.name.lower())
+                ttl = record.ttl if ttl is None else min(ttl, record.ttl)
+        if cut is None:
+            return None
+
+        # Glue outside of the zone being left could be forged
+        addresses = []
+        for record in message.additional:
+            if record.rtype == 1 and record.name.lower() in names and \
+                    in_zone(record.name.lower(), zone):
+                addresses.append(record.rdata.address)
+                ttl = min(ttl, record.ttl)
+
+        return Referral(cut, names, addresses, ttl)
+
+    def lookup(self, names, depth):
+        '''The IPv4 addresses of the first nameserver that resolves'''
+        for ns in names:
+            try:
+                data, _, _ = self.resolve(ns, 'A', depth)
+                message = WireParser(data).parse()
+                addresses = [record.rdata.address
+                             for record in message.answer
+                             if record.rtype == 1]
+            except (IndexError, OSError, ValueError):
+                continue
+            if addresses:
+                return addresses
+
+        return []
+
+
+if __name__ == '__main__':
+    print('This is the file for the iterative resolver, run dns.py instead')
@@ -0,0 +1,295 @@
+from query import rtype_codes
+from records import Slotted
+from response import DnsResponseBuilder
+
+'''
+Structured results of lookups and the writers rendering them.
+A Result is made once per answer and handed to one writer: the text
+one prints the nslookup style output, the JSON Lines and CSV ones a
+row per record with its section, the response code, the server that
+answered and the round trip time.
+'''
+
+type_names = {code: name.decode('utf-8')
+              for name, code in rtype_codes.items()}
+type_names[41] = 'OPT'
+
+rcode_names = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN',
+               4: 'NOTIMP', 5: 'REFUSED', 6: 'YXDOMAIN', 7: 'YXRRSET',
+               8: 'NOTAUTH', 9: 'NOTZONE', 16: 'BADVERS'}
+
+columns = ('query', 'qtype', 'section', 'name', 'type', 'ttl', 'rdata',
+           'rcode', 'error', 'server', 'rtt_ms')
+
+
+def type_name(rtype):
+    '''The mnemonic of a record type, TYPEn for unknown ones (RFC 3597)'''
+    if isinstance(rtype, bytes):
+        return rtype.decode('utf-8')
+    return type_names.get(rtype, 'TYPE{}'.format(rtype))
+
+
+class Result(Slotted):
+    '''
+    The outcome of one lookup. response is the DnsResponseBuilder of
+    the answer, None if there was no answer, and error the message of a
+    failed lookup. server is the (address, port) that answered and rtt
+    the seconds it took, both None for answers from the cache.
+    '''
+    __slots__ = ('url', 'rtype', 'response', 'error', 'server', 'rtt')
+
+    def __init__(self, url, rtype, response=None, error=None, server=None,
+                 rtt=None):
+        self.url = url
+        self.rtype = rtype
+        self.response = response
+        self.error = error
+        self.server = server
+        self.rtt = rtt
+
+    @property
+    def rcode(self):
+        if self.response is None:
+            return None
+        return self.response.rcode
+
+    def sections(self):
+        '''Yields (section, record) of every record, OPT left out'''
+        response = self.response
+        if response is None:
+            return
+        for section, records in (('answer', response.answer_records),
+                                 ('authority', response.authority_records),
+                                 ('additional',
+                                  response.additional_records)):
+            for record in records:
+                if record.rtype != 41:
+                    yield section, record
+
+    def rows(self):
+        '''
+        One tuple of the columns per record, a lookup without any
+        record gives a single row without the record columns
+        '''
+        rcode = self.rcode
+        if rcode is not None:
+            rcode = rcode_names.get(rcode, str(rcode))
+        server = None
+        if self.server is not None:
+            server = '{}#{}'.format(*self.server)
+        rtt = None
+        if self.rtt is not None:
+            rtt = round(self.rtt * 1000, 3)
+        qtype = type_name(self.rtype)
+
+        empty = True
+        for section, record in self.sections():
+            empty = False
+            yield (self.url, qtype, section, record.name,
+                   type_name(record.rtype), record.ttl, str(record.rdata),
+                   rcode, self.error, server, rtt)
+        if empty:
+            yield (self.url, qtype, None, None, None, None, None, rcode,
+                   self.error, server, rtt)
+
+
+def make_result(data, length, url, q_id, rtype, server=None, rtt=None):
+    '''
+    Checks and parses the answer. Every record of the three sections
+    is decoded here, so that a malformed one fails this Result rather
+    than the writer, and with it the rest of a batch.
+    '''
+    response = DnsResponseBuilder(data, length, url, q_id)
+    try:
+        response.create_header()
+        response.error_check()
+        if response.error[0] != -1:
+            response.parse()
+            for section in (response.answer_records,
+                            response.authority_records,
+                            response.additional_records):
+                for _ in section:
+                    pass
+    except (IndexError, ValueError) as error:
+        return Result(url, rtype, None, 'Malformed response: {}'.format(
+            error), server, rtt)
+
+    error = None if response.is_valid else response.error[1]
+    return Result(url, rtype, response, error, server, rtt)
+
+
+def format_SOA(name, rdata):
+    return '{}\n\t orgin: {}\n\t mail addr: {}\n\t serial: {}\n' \
+        '\t refresh: {}\n\t retry: {}\n\t expire: {}\n\t minimum: {}\n' \
+        .format(name, rdata.mname, rdata.rname, rdata.serial, rdata.refresh,
+                rdata.retry, rdata.expire, rdata.minimum)
+
+
+def format_answer(url, qtype, records):
+    '''The answer section as nslookup prints it'''
+    if not records:
+        return ''
+
+    rdatas = [record.rdata for record in records if record.rtype == qtype]
+    if qtype == 1 or qtype == 28:
+        return '\n'.join('Name: {}\nAddress: {}'.format(url, rdata.address)
+                         for rdata in rdatas)
+    elif qtype == 2:
+        return ''.join('{}\t nameserver = {}\n'.format(url, rdata.name)
+                       for rdata in rdatas)
+    elif qtype == 5:
+        return ''.join('{}\t canonical name = {}\n'.format(url, rdata.name)
+                       for rdata in rdatas)
+    elif qtype == 6:
+        return format_SOA(url, rdatas[0])
+    elif qtype == 16:
+        return ''.join('{}\t{}\n'.format(url, rdata) for rdata in rdatas)
+    elif qtype == 15:
+        return ''.join('{}\t mail exchanger = {} {}\n'.format(
+            url, rdata.preference, rdata.exchange) for rdata in rdatas)
+    elif qtype == 12:
+        return ''.join('{}\t name = {}\n'.format(url, rdata.name)
+                       for rdata in rdatas)
+
+    return 'The option is invalid'
+
+
+def format_authority(records):
+    authority = []
+    for record in records:
+        if record.rtype == 2:
+            authority.append('{}\t nameserver = {}\n'.format(
+                record.name, record.rdata.name))
+        elif record.rtype == 6:
+            authority.append(format_SOA(record.name, record.rdata))
+
+    return ''.join(authority)
+
+
+def format_additional(records):
+    additional = []
+    for record in records:
+        if record.rtype == 1:
+            additional.append('{} has an internet address = {}\n'.format(
+                record.name, record.rdata.address))
+        elif record.rtype == 28:
+            additional.append('{} has AAAA address = {}\n'.format(
+                record.name, record.rdata.address))
+
+    return ''.join(additional)
+
+
+class TextWriter:
+    '''
+    The nslookup style output. With any_mode set, as for --rtype=ANY,
+    only the answers are printed.
+    '''
+
+    def __init__(self, stream, any_mode=False):
+        self.stream = stream
+        self.any_mode = any_mode
+
+    def note(self, line):
+        self.stream.write(line + '\n')
+
+    def write(self, result):
+        self.stream.write(self.render(result))
+
+    def render(self, result):
+        response = result.response
+        if response is None:
+            rtype = type_name(result.rtype)
+            return '*** {} ({}): {}\n\n'.format(
+                result.url, rtype, result.error or 'Connection Timed Out')
+
+        if not response.is_valid:
+            if response.error[0] == -1:
+                return response.error[1] + '\n\n'
+            return 'Error No.: {}\n{}\n'.format(*response.error)
+
+        header = response.header
+        url = response.url
+        if header.num_response == 0 and header.num_authority == 0:
+            return "Non-authoritative answer:\n*** Can't find {}: " \
+                "No answer\n\nAuthoritative answers can be found from " \
+                "here\n\n".format(url)
+
+        answer = format_answer(url, response.qtype, response.answer_records)
+        if self.any_mode:
+            return answer + '\n'
+
+        if response.qtype == 1 or response.qtype == 28:
+            return 'Non-authoritative answer:\n' + answer + '\n'
+
+        if header.auth_ans:
+            return 'Authoritative answers can be found from here\n\n' + \
+                answer + '\n'
+
+        text = ['Non-authoritative answer:\n']
+        if header.num_response:
+            text.append(answer + '\n')
+        else:
+            text.append("*** Can't find {}: No answer\n\n".format(url))
+        text.append('Authoritative answers can be found from here\n')
+        authority = format_authority(response.authority_records)
+        additional = format_additional(response.additional_records)
+        if authority:
+            text.append(authority + '\n')
+        if additional:
+            text.append(additional + '\n')
+        if not (authority or additional):
+            text.append('\n\n')
+
+        return ''.join(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class JsonLinesWriter:
+    '''One JSON object per record, with the keys of columns'''
+
+    def __init__(self, stream):
+        # The formats are imported when chosen, not on every start
+        import json
+        self.stream = stream
+        self.encoder = json.JSONEncoder(ensure_ascii=False,
+                                        separators=(',', ':'))
+
+    def note(self, line):
+        pass
+
+    def write(self, result):
+        self.stream.write(''.join(
+            self.encoder.encode(dict(zip(columns, row))) + '\n'
+            for row in result.rows()))
+
+    def flush(self):
+        self.stream.flush()
+
+
+class CsvWriter:
+    '''One CSV line per record under a header line of the columns'''
+
+    def __init__(self, stream, header=True):
+        import csv
+        self.stream = stream
+        self.writer = csv.writer(stream, lineterminator='\n')
+        if header:
+            self.writer.writerow(columns)
+
+    def note(self, line):
+        pass
+
+    def write(self, result):
+        self.writer.writerows(result.rows())
+
+    def flush(self):
+        self.stream.flush()
+
+
+writers = {'text': TextWriter, 'jsonl': JsonLinesWriter, 'csv': CsvWriter}
+
+
+if __name__ == '__main__':
+    print('This is the file for the output formats, run dns.py instead')
@@ -1,119 +1,134 @@
+import os
 import struct
-from random import randint
+from functools import lru_cache
+
+'''
+Options omitted are the obsolete and experimental ones:
+MD ==> 3
+MF ==> 4
+MB ==> 7
+MG ==> 8
+MR ==> 9
+NULL ==> 10
+'''
+rtype_codes = {b'A': 1, b'NS': 2, b'CNAME': 5, b'SOA': 6, b'WKS': 11,
+               b'PTR': 12, b'HINFO': 13, b'MINFO': 14, b'MX': 15,
+               b'TXT': 16, b'RP': 17, b'AFSDB': 18, b'X25': 19,
+               b'ISDN': 20, b'RT': 21, b'NSAP': 22, b'NSAP-PTR': 23,
+               b'SIG': 24, b'KEY': 25, b'PX': 26, b'GPOS': 27,
+               b'AAAA': 28}
+
+header_struct = struct.Struct('>HHHHHH')
+question_struct = struct.Struct('>HH')
+'''
+EDNS(0) OPT pseudo-record (RFC 6891): root name, type 41, the UDP
+payload size in place of the class and the extended RCODE, version
+and flags in place of the TTL, without any options.
+'''
+opt_struct = struct.Struct('>BHHLH')
+
+
+def new_query_id():
+    '''
+    A random query ID, read from os.urandom as the random module
+    takes longer to import than a lookup takes to build
+    '''
+    return int.from_bytes(os.urandom(2), 'big')
+
+
+def random_fraction():
+    '''A random number in [0, 1), for jitter'''
+    return int.from_bytes(os.urandom(4), 'big') / 4294967296
+
+
+@lru_cache(maxsize=4096)
+def encode_question(url, rtype):
+    '''
+    Encodes the question section for the URL and type of query.
+    If the first label is a number, the URL is an IP address and a
+    PTR query for its in-addr.arpa name is made instead, an IPv6
+    address gets a PTR query for its ip6.arpa name.
+    Returns the queried name, whether it is a reverse query and the
+    question in wire format. As the result only depends on the
+    arguments, it is cached so repeated queries only need a new header.
+    '''
+    split_url = url.split('.')
+    reverse = False
+    qtype = rtype_codes.get(rtype, 1)
+    if ':' in url:
+        # Only IPv6 addresses need it, so it is not loaded on start up
+        import ipaddress
+        try:
+            url = ipaddress.IPv6Address(url).reverse_pointer
+            split_url = url.split('.')
+            reverse = True
+            qtype = 12
+        except ValueError:
+            pass
+
+    else:
+        try:
+            int(split_url[0])
+            split_url = split_url[::-1]
+            split_url.append('in-addr')
+            split_url.append('arpa')
+            url = '.'.join(split_url)
+            reverse = True
+            qtype = 12
+
+        except ValueError:
+            pass
+
+    question = bytearray()
+    for label in split_url:
+        if label == '':
+            continue
+        label = label.encode('utf-8')
+        if len(label) > 63:
+            raise ValueError('Label is longer than 63 bytes: {}'.format(url))
+        question.append(len(label))
+        question += label
+    question.append(0)  # End of String
+    question += question_struct.pack(qtype, 1)  # Query Type and Class
+
+    return url, reverse, bytes(question)
 
 
 class DnsQueryBuilder:
 
-    def __init__(self):
+    def __init__(self, bufsize=0):
         self.url = ""
         self.rtype = "A"
         self.reverse = False
-        self.q_id = randint(0, 65535)
+        self.q_id = new_query_id()
         self.length = 0
+        self.bufsize = bufsize
 
     def build_query_packet(self, url, rtype, recurse):
         '''
         The function builds the query for the entered URL and type
-        of query. The query has a format in which it is made. The
+        of query. The header is packed in one go and the question
+        comes from encode_question, so only the query ID changes
+        between queries for the same URL and type.
+        If bufsize is set, an OPT record advertising it as the UDP
+        payload size is added. length is the size of the header and
+        question only, as the answers start right after them.
         '''
-        query_packet = struct.pack(">H", self.q_id)  # Query Ids
+        if isinstance(rtype, str):
+            rtype = rtype.encode('utf-8')
+        self.url, self.reverse, question = encode_question(url, rtype)
 
         '''Making the query allow for non-authoritative response'''
-        if not recurse:
-            query_packet += struct.pack(">H", 256)
-        else:
-            query_packet += struct.pack(">H", 384)
-
-        '''Remaining values are generic and default values for query'''
-        query_packet += struct.pack(">H", 1)
-        query_packet += struct.pack(">H", 0)
-        query_packet += struct.pack(">H", 0)
-        query_packet += struct.pack(">H", 0)
-
-        split_url = url.split(".")
-        try:
-            '''If reverse, the split_url will be int, this block will be used'''
-            if isinstance(int(split_url[0]), int):
-                split_url = split_url[::-1]
-                split_url.append('in-addr')
-                split_url.append('arpa')
-                self.url = '.'.join(split_url)
-                for split in split_url:
-                    query_packet += struct.pack('B', len(split))
-                    for byte in split:
-                        query_packet += struct.pack('c', byte.encode('utf-8'))
-            query_packet += struct.pack("B", 0)
-            '''End of string is achieved above'''
-            '''For inverse, the Query Type has been added hard-coded'''
-            query_packet += struct.pack(">H", 12)
-            query_packet += struct.pack(">H", 1)  # Query Class
-            self.reverse = True
+        flags = 384 if recurse else 256
+        additional = 1 if self.bufsize else 0
+        query_packet = header_struct.pack(self.q_id, flags, 1, 0, 0,
+                                          additional)
+        query_packet += question
+        self.length = len(query_packet)
 
-        except ValueError:
-            self.url = url
-            for part in split_url:
-                query_packet += struct.pack("B", len(part))
-                for byte in part:
-                    query_packet += struct.pack("c", byte.encode('utf-8'))
-            query_packet += struct.pack("B", 0)  # End of String
-
-            '''
-            Options omitted are the obsolete and experimental ones:
-            MD ==> 3
-            MF ==> 4
-            MB ==> 7
-            MG ==> 8
-            MR ==> 9
-            NULL ==> 10
-            '''
-            if rtype == b"NS":
-                query_packet += struct.pack(">H", 2)
-            elif rtype == b"CNAME":
-                query_packet += struct.pack(">H", 5)
-            elif rtype == b"SOA":
-                query_packet += struct.pack(">H", 6)
-            elif rtype == b'WKS':
-                query_packet += struct.pack(">H", 11)
-            elif rtype == b'PTR':
-                query_packet += struct.pack(">H", 12)
-            elif rtype == b'HINFO':
-                query_packet += struct.pack(">H", 13)
-            elif rtype == b'MINFO':
-                query_packet += struct.pack(">H", 14)
-            elif rtype == b"MX":
-                query_packet += struct.pack(">H", 15)
-            elif rtype == b"TXT":
-                query_packet += struct.pack(">H", 16)
-            elif rtype == b'RP':
-                query_packet += struct.pack(">H", 17)
-            elif rtype == b'AFSDB':
-                query_packet += struct.pack(">H", 18)
-            elif rtype == b'X25':
-                query_packet += struct.pack(">H", 19)
-            elif rtype == b'ISDN':
-                query_packet += struct.pack(">H", 20)
-            elif rtype == b'RT':
-                query_packet += struct.pack(">H", 21)
-            elif rtype == b'NSAP':
-                query_packet += struct.pack(">H", 22)
-            elif rtype == b'NSAP-PTR':
-                query_packet += struct.pack(">H", 23)
-            elif rtype == b'SIG':
-                query_packet += struct.pack(">H", 24)
-            elif rtype == b'KEY':
-                query_packet += struct.pack(">H", 25)
-            elif rtype == b'PX':
-                query_packet += struct.pack(">H", 26)
-            elif rtype == b'GPOS':
-                query_packet += struct.pack(">H", 27)
-            elif rtype == b"AAAA":
-                query_packet += struct.pack(">H", 28)
-            else:
-                query_packet += struct.pack(">H", 1)
-
-            query_packet += struct.pack(">H", 1)  # Query Class
+        if self.bufsize:
+            query_packet += opt_struct.pack(0, 41, self.bufsize, 0, 0)
 
-        self.length = len(query_packet)
         return query_packet
 
 
@@ -0,0 +1,129 @@
+import time
+import instrument
+
+
+class TokenBucket:
+    '''
+    Allows rate events per second on average, with bursts of up to
+    burst events. Tokens are added continuously as time passes, an
+    event takes one.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1.0, self.rate / 10)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        '''Seconds until a token is available, 0 if there is one now'''
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class AimdWindow:
+    '''
+    Adaptive number of queries kept in flight, between minimum and
+    maximum, grown and cut the way TCP congestion control does it.
+    It starts at initial and grows by increase with every success,
+    doubling once per window of answers, until the first failure.
+    From then on a success grows it by increase / size, about
+    increase per window of answers, and a failure (a timeout, SERVFAIL
+    or REFUSED) cuts it by the factor decrease. The queries already in
+    flight when it was cut were sent with the larger window, so their
+    failures do not cut it again.
+    '''
+
+    def __init__(self, maximum, minimum=1, initial=None, increase=1.0,
+                 decrease=0.5):
+        self.maximum = max(minimum, maximum)
+        self.minimum = minimum
+        if initial is None:
+            initial = max(minimum, maximum // 4)
+        self.size = float(min(initial, self.maximum))
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_start = True
+        self.completed = 0
+        self.guard = 0
+        self.cuts = 0
+        self.publish()
+
+    def limit(self):
+        return max(self.minimum, int(self.size))
+
+    def success(self):
+        self.completed += 1
+        if self.size >= self.maximum:
+            return
+        before = self.limit()
+        if self.slow_start:
+            self.size += self.increase
+        else:
+            self.size += self.increase / self.size
+        self.size = min(self.size, self.maximum)
+        if self.limit() != before:
+            self.publish()
+
+    def failure(self):
+        self.completed += 1
+        if self.completed < self.guard:
+            return
+        self.guard = self.completed + self.limit()
+        self.slow_start = False
+        self.size = max(self.minimum, self.size * self.decrease)
+        self.cuts += 1
+        if instrument.recorder is not None:
+            instrument.recorder.count('window cuts')
+        self.publish()
+
+    def publish(self):
+        if instrument.recorder is not None:
+            instrument.recorder.gauge('window', self.limit())
+
+
+class SharedTokenBucket(TokenBucket):
+    '''
+    A TokenBucket shared by the processes it is handed to, for one
+    rate over all of them. The tokens and the time they were counted
+    at live in shared memory, behind its lock. The monotonic clock is
+    the same for every process of the host.
+    '''
+
+    def __init__(self, rate, burst=None):
+        # Only the sharded mode needs it, and it is slow to import
+        import multiprocessing
+        super().__init__(rate, burst)
+        self.state = multiprocessing.Array('d', [self.tokens, self.updated])
+
+    def delay(self):
+        with self.state.get_lock():
+            now = time.monotonic()
+            tokens = min(self.burst, self.state[0] +
+                         (now - self.state[1]) * self.rate)
+            self.state[0] = tokens
+            self.state[1] = now
+        if tokens >= 1:
+            return 0
+        return (1 - tokens) / self.rate
+
+    def take(self):
+        with self.state.get_lock():
+            self.state[0] -= 1
+
+
+if __name__ == '__main__':
+    print('This is the file for the rate limiter, run dns.py instead')
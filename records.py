@@ -0,0 +1,206 @@
+'''
+Compact record model of a parsed DNS message.
+Every class uses __slots__, so a parsed record costs a handful of
+pointers instead of a dict per record.
+'''
+
+
+class Slotted:
+    '''Base class giving the slotted classes a repr and equality'''
+    __slots__ = ()
+
+    def values(self):
+        '''The (name, value) pairs of the slots, subclasses included'''
+        values = []
+        for cls in reversed(type(self).__mro__):
+            for name in cls.__dict__.get('__slots__', ()):
+                values.append((name, getattr(self, name)))
+
+        return values
+
+    def __repr__(self):
+        fields = ', '.join('{}={!r}'.format(name, value)
+                           for name, value in self.values())
+        return '{}({})'.format(type(self).__name__, fields)
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return self.values() == other.values()
+
+    def __hash__(self):
+        return hash(tuple(self.values()))
+
+
+class Header(Slotted):
+    __slots__ = ('identification', 'is_query', 'opcode', 'auth_ans',
+                 'truncated', 'recursion_wanted', 'recursion_supported',
+                 'present_in_zone', 'rcode', 'num_queries', 'num_response',
+                 'num_authority', 'num_additional')
+
+    def __init__(self, identification, flags, num_queries, num_response,
+                 num_authority, num_additional):
+        '''
+        Flags contain 16-bits, and the order is:
+        16 - QR (1 = Response)
+        17, 20 - Opcode (0 = Standard Query, 1 = Inverse Query)
+        21 - Authoratative flag (1 = Authoratative Answer)
+        22 - Truncated flag (1 = Truncated)
+        23 - Recursion desired (1 = Desired)
+        24 - Recursion available (1 = Support available)
+        25 - Z
+        26, 27 - Not important for now
+        28, 31 - Response code.
+        '''
+        self.identification = identification
+        self.is_query = (flags & 32768) != 0
+        self.opcode = (flags & 30720) >> 11
+        self.auth_ans = (flags & 1024) != 0
+        self.truncated = (flags & 512) != 0
+        self.recursion_wanted = (flags & 256) != 0
+        self.recursion_supported = (flags & 128) != 0
+        self.present_in_zone = not(bool((flags & 112) >> 4))
+        self.rcode = flags & 15
+        self.num_queries = num_queries
+        self.num_response = num_response
+        self.num_authority = num_authority
+        self.num_additional = num_additional
+
+
+class Question(Slotted):
+    __slots__ = ('name', 'qtype', 'qclass')
+
+    def __init__(self, name, qtype, qclass):
+        self.name = name
+        self.qtype = qtype
+        self.qclass = qclass
+
+
+class ResourceRecord(Slotted):
+    __slots__ = ('name', 'rtype', 'rclass', 'ttl', 'rdata')
+
+    def __init__(self, name, rtype, rclass, ttl, rdata):
+        self.name = name
+        self.rtype = rtype
+        self.rclass = rclass
+        self.ttl = ttl
+        self.rdata = rdata
+
+
+class A(Slotted):
+    __slots__ = ('address',)
+    rtype = 1
+
+    def __init__(self, address):
+        self.address = address
+
+    def __str__(self):
+        return self.address
+
+
+class AAAA(A):
+    __slots__ = ()
+    rtype = 28
+
+
+class NS(Slotted):
+    __slots__ = ('name',)
+    rtype = 2
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class CNAME(NS):
+    __slots__ = ()
+    rtype = 5
+
+
+class PTR(NS):
+    __slots__ = ()
+    rtype = 12
+
+
+class MX(Slotted):
+    __slots__ = ('preference', 'exchange')
+    rtype = 15
+
+    def __init__(self, preference, exchange):
+        self.preference = preference
+        self.exchange = exchange
+
+    def __str__(self):
+        return '{} {}'.format(self.preference, self.exchange)
+
+
+class SOA(Slotted):
+    __slots__ = ('mname', 'rname', 'serial', 'refresh', 'retry', 'expire',
+                 'minimum')
+    rtype = 6
+
+    def __init__(self, mname, rname, serial, refresh, retry, expire,
+                 minimum):
+        self.mname = mname
+        self.rname = rname
+        self.serial = serial
+        self.refresh = refresh
+        self.retry = retry
+        self.expire = expire
+        self.minimum = minimum
+
+    def __str__(self):
+        return '{} {} {} {} {} {} {}'.format(
+            self.mname, self.rname, self.serial, self.refresh, self.retry,
+            self.expire, self.minimum)
+
+
+class TXT(Slotted):
+    __slots__ = ('strings',)
+    rtype = 16
+
+    def __init__(self, strings):
+        self.strings = tuple(strings)
+
+    def __str__(self):
+        return ''.join(self.strings)
+
+
+class OPT(Slotted):
+    '''
+    EDNS(0) pseudo-record (RFC 6891), the UDP payload size is carried
+    in the class and the extended RCODE, version and flags in the TTL
+    '''
+    __slots__ = ('payload_size', 'extended_rcode', 'version', 'dnssec_ok',
+                 'options')
+    rtype = 41
+
+    def __init__(self, payload_size, extended_rcode, version, dnssec_ok,
+                 options):
+        self.payload_size = payload_size
+        self.extended_rcode = extended_rcode
+        self.version = version
+        self.dnssec_ok = dnssec_ok
+        self.options = bytes(options)
+
+    def __str__(self):
+        return 'EDNS: version: {}, udp: {}'.format(self.version,
+                                                   self.payload_size)
+
+
+class Unknown(Slotted):
+    '''Record data of a type that is not decoded, kept as bytes'''
+    __slots__ = ('rtype', 'data')
+
+    def __init__(self, rtype, data):
+        self.rtype = rtype
+        self.data = bytes(data)
+
+    def __str__(self):
+        return '\\# {} {}'.format(len(self.data), self.data.hex())
+
+
+if __name__ == '__main__':
+    print('This is the file for the record classes, run dns.py instead')
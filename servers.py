@@ -0,0 +1,250 @@
+import time
+import select
+import socket
+import sys
+import instrument
+from functools import lru_cache
+from query import random_fraction
+from transport import resolve_server
+
+
+def get_nameservers(path='/etc/resolv.conf'):
+    '''
+    Every nameserver listed in resolv.conf, in order. The file is
+    only read the first time, and only when no server was given.
+    '''
+    return list(read_nameservers(path))
+
+
+@lru_cache(maxsize=None)
+def read_nameservers(path):
+    servers = []
+    try:
+        with open(path) as dns:
+            for line in dns:
+                if line != '\n' and line[0] != '#':
+                    data = line.split()
+                    if len(data) > 1 and data[0] == 'nameserver':
+                        servers.append(data[1])
+    except OSError:
+        pass
+
+    return tuple(servers) or ('127.0.0.53',)
+
+
+def rcode_of(data):
+    return data[3] & 15
+
+
+class QueryTimeout(socket.timeout):
+    '''
+    Raised, or handed out as the result of a query, when no server
+    answered before the deadline. servers are the ones the query was
+    sent to, tries the number of datagrams sent.
+    '''
+
+    def __init__(self, servers, tries, elapsed):
+        self.servers = list(servers)
+        self.tries = tries
+        self.elapsed = elapsed
+        super().__init__('Connection Timed Out after {} {} to {} ({:.2f}s)'
+                         .format(tries, 'try' if tries == 1 else 'tries',
+                                 ', '.join('{}#{}'.format(*server)
+                                           for server in self.servers),
+                                 elapsed))
+
+
+class ServerStats:
+    '''
+    Smoothed round trip time of a server, kept like the one of TCP
+    (RFC 6298) with gains of 1/8 for srtt and 1/4 for rttvar
+    '''
+    __slots__ = ('srtt', 'rttvar', 'failures', 'samples')
+
+    def __init__(self, srtt):
+        self.srtt = srtt
+        self.rttvar = srtt / 2
+        self.failures = 0
+        self.samples = 0
+
+
+class ServerSelector:
+    '''
+    Keeps an RTT estimate for every upstream server and orders them
+    fastest first. Servers that were never asked start with a small
+    random estimate, so all of them get tried early on. A server that
+    times out or answers SERVFAIL/REFUSED gets its estimate doubled.
+    Unanswered queries are sent again after the RTO of the server,
+    which doubles with every try (with some jitter) up to max_backoff.
+    Until a server has answered once its RTO is initial_rto. A single
+    lookup moves on to the next server once the backoff of the
+    server_tries-th send to a server runs out.
+    The sockets are IPv4 only, so IPv6 servers and names that do not
+    resolve are left out with a warning on stderr, and ValueError is
+    raised if no server is left.
+    '''
+
+    def __init__(self, servers, port=53, race=False, min_delay=0.02,
+                 max_delay=1.0, initial_rto=0.4, max_backoff=8.0,
+                 jitter=0.1, server_tries=2):
+        if isinstance(servers, (str, bytes)):
+            servers = [servers]
+        self.servers = []
+        for server in servers:
+            try:
+                address = resolve_server(server, port)
+            except OSError as error:
+                sys.stderr.write('*** Skipping server {}: {}\n'.format(
+                    server, error))
+                continue
+            if address not in self.servers:
+                self.servers.append(address)
+        if not self.servers:
+            raise ValueError('No usable IPv4 server in {}'.format(
+                ', '.join(map(str, servers))))
+        self.stats = {server: ServerStats(0.001 + 0.004 * random_fraction())
+                      for server in self.servers}
+        self.race = race
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.initial_rto = initial_rto
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.server_tries = server_tries
+
+    def __len__(self):
+        return len(self.servers)
+
+    def srtt(self, server):
+        return self.stats[server].srtt
+
+    def ordered(self):
+        return sorted(self.servers, key=self.srtt)
+
+    def best(self):
+        return min(self.servers, key=self.srtt)
+
+    def record_rtt(self, server, rtt):
+        stats = self.stats[server]
+        stats.rttvar += (abs(rtt - stats.srtt) - stats.rttvar) / 4
+        stats.srtt += (rtt - stats.srtt) / 8
+        stats.failures = 0
+        stats.samples += 1
+
+    def record_failure(self, server):
+        stats = self.stats[server]
+        stats.srtt = min(stats.srtt * 2 + self.min_delay, 60)
+        stats.failures += 1
+
+    def rto(self, server):
+        '''Time to wait for the server, srtt + 4 * rttvar (RFC 6298)'''
+        stats = self.stats[server]
+        if not stats.samples:
+            return self.initial_rto
+        return min(max(stats.srtt + 4 * stats.rttvar, self.min_delay),
+                   self.max_delay)
+
+    def backoff(self, server, tries):
+        '''
+        Time to wait after the tries-th send of a query to server before
+        sending it again. The jitter keeps the retries of many queries
+        lost at once from going out in step.
+        '''
+        delay = min(self.rto(server) * 2 ** (tries - 1), self.max_backoff)
+        return delay * (1 + self.jitter * (2 * random_fraction() - 1))
+
+    def exchange(self, pool, packet, timeout, bufsize=512):
+        '''
+        Sends the packet to the fastest server and sends it again, with
+        the same ID, each time the backoff runs out. If racing, every
+        retry goes to the next server in turn, otherwise a server gets
+        server_tries sends before the next one is tried, the last one
+        left being tried until the timeout. An answer from any server
+        the packet was sent to is accepted, and SERVFAIL or REFUSED
+        moves on to the next server right away.
+        Returns the answer and the server it came from, raises
+        QueryTimeout if no server answers within timeout.
+        '''
+        servers = self.ordered()
+        q_id = packet[:2]
+        sent = {}
+        tries = {}
+        failed = None
+        attempt = 0
+        start = time.monotonic()
+        deadline = start + timeout
+        next_send = start
+        sock = pool.acquire()
+        try:
+            sock.setblocking(False)
+            while True:
+                now = time.monotonic()
+                if now >= deadline or not servers:
+                    for server in sent:
+                        self.record_failure(server)
+                    if failed is not None:
+                        return failed
+                    raise QueryTimeout(list(tries), sum(tries.values()),
+                                       now - start)
+
+                if now >= next_send:
+                    if not self.race and len(servers) > 1 and \
+                            tries.get(servers[0], 0) >= self.server_tries:
+                        self.record_failure(servers.pop(0))
+                    if self.race:
+                        server = servers[attempt % len(servers)]
+                    else:
+                        server = servers[0]
+                    attempt += 1
+                    if attempt > 1 and instrument.recorder is not None:
+                        instrument.recorder.count('retries')
+                    sock.sendto(packet, server)
+                    sent[server] = now
+                    tries[server] = tries.get(server, 0) + 1
+                    next_send = now + self.backoff(server, tries[server])
+
+                wake = min(deadline, next_send)
+                readable, _, _ = select.select([sock], [], [], wake - now)
+                if not readable:
+                    continue
+
+                while True:
+                    try:
+                        data, addr = sock.recvfrom(bufsize)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except ConnectionRefusedError:
+                        continue
+                    server = addr[:2]
+                    if server not in sent or data[:2] != q_id:
+                        continue
+
+                    # Karn: the answer to a resent query gives no sample
+                    if tries[server] == 1:
+                        self.record_rtt(server,
+                                        time.monotonic() - sent[server])
+                    del sent[server]
+                    if rcode_of(data) in (2, 5) and server in servers and \
+                            len(servers) > 1:
+                        # Failing over, the answer is kept in case no
+                        # other server does better
+                        self.record_failure(server)
+                        if instrument.recorder is not None:
+                            instrument.recorder.count('failovers')
+                        failed = (data, server)
+                        servers.remove(server)
+                        next_send = time.monotonic()
+                        continue
+                    return data, server
+
+        except OSError as exc:
+            if not isinstance(exc, QueryTimeout):
+                sock.close()
+            raise
+        finally:
+            if sock.fileno() != -1:
+                pool.release(sock)
+
+
+if __name__ == '__main__':
+    print('This is the file for the server selection, run dns.py instead')
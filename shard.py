@@ -0,0 +1,291 @@
+import io
+import itertools
+import marshal
+import multiprocessing
+import os
+from collections import deque
+from multiprocessing.connection import wait
+import instrument
+from batch import BatchResolver
+from cache import DnsCache
+from diskcache import DiskCache
+from output import CsvWriter, Result, make_result, rcode_names, writers
+from ratelimit import SharedTokenBucket
+from servers import ServerSelector
+from transport import resolve_server
+
+'''
+Batch lookups spread over a pool of processes, so that parsing and
+formatting the answers, which are pure Python, use every core.
+The parent reads the names and hands them out in chunks, each worker
+resolves them with a BatchResolver of its own, over its own socket,
+and sends back the formatted output over a pipe. The workers take
+their queries from one SharedTokenBucket, so --rate holds for the
+whole pool. With instrument enabled in the parent, every worker
+records its own statistics and sends them back with its last message,
+to be merged into the recorder of the parent.
+'''
+
+
+def render(writer, buffer, result):
+    '''The output of one Result, as the writer formats it'''
+    writer.write(result)
+    text = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return text
+
+
+def record(recorder, data, result, rtt, started, decoded):
+    '''The statistics dns.py keeps of every answer it writes'''
+    if not isinstance(data, bytes):
+        recorder.count('failed')
+        return
+    if rtt is not None:
+        recorder.timing('exchange', rtt)
+    recorder.timing('decode', decoded - started)
+    recorder.timing('format', instrument.clock() - decoded)
+    if result.rcode is not None:
+        recorder.count('rcode ' + rcode_names.get(result.rcode,
+                                                  str(result.rcode)))
+
+
+def work(config, tasks, results, limiter, server_limiters):
+    '''
+    The loop of a worker process. Chunks of (seq, url, rtype) are read
+    from tasks until None, and (credits, rows, stats) messages are
+    written to results, rows being (seq, output) pairs and credits the
+    number of chunks taken since the last message, so the parent can
+    send more. stats is None but in the last message with stats set in
+    config, where it is what the Recorder of the worker exported.
+    '''
+    # Forked with the recorder of the parent, which is not shared
+    recorder = instrument.enable() if config['stats'] else None
+    if recorder is None:
+        instrument.disable()
+
+    buffer = io.StringIO()
+    if config['format'] == 'csv':
+        writer = CsvWriter(buffer, header=False)
+    else:
+        writer = writers[config['format']](buffer)
+    cache = None
+    if config['cache_file'] is not None:
+        cache = DiskCache(config['cache_file'], config['cache_size'])
+    elif config['cache_size'] > 0:
+        cache = DnsCache(config['cache_size'])
+    resolver = BatchResolver(
+        ServerSelector(config['dns'], config['port'], config['race']),
+        config['port'], config['concurrency'], config['timeout'],
+        config['recurse'], cache, config['tcp'], bufsize=config['bufsize'],
+        limiter=limiter, server_limiters=server_limiters,
+        adaptive=config['adaptive'])
+
+    seqs = {}
+    rows = []
+    credits = [0]
+
+    def flush(stats=None):
+        results.send_bytes(marshal.dumps((credits[0], rows, stats)))
+        credits[0] = 0
+        del rows[:]
+
+    def items():
+        while True:
+            if not tasks.poll():
+                # No names yet, the resolver goes on with the answers due
+                if resolver.pending:
+                    yield None
+                    continue
+                # The parent may be waiting on these rows to send more
+                if rows:
+                    flush()
+            try:
+                chunk = marshal.loads(tasks.recv_bytes())
+            except EOFError:
+                return
+            if chunk is None:
+                return
+            credits[0] += 1
+            flush()
+            for seq, url, rtype in chunk:
+                seqs.setdefault((url, rtype), deque()).append(seq)
+                yield url, rtype
+
+    try:
+        for url, rtype, builder, data, server, rtt in \
+                resolver.resolve(items()):
+            if recorder is not None:
+                started = instrument.clock()
+            if isinstance(data, bytes):
+                result = make_result(data, builder.length, builder.url,
+                                     builder.q_id, rtype, server, rtt)
+            else:
+                result = Result(url, rtype,
+                                error=str(data) or 'Connection Timed Out')
+            if recorder is not None:
+                decoded = instrument.clock()
+            rows.append((seqs[url, rtype].popleft(),
+                         render(writer, buffer, result)))
+            if recorder is not None:
+                record(recorder, data, result, rtt, started, decoded)
+            if not seqs[url, rtype]:
+                del seqs[url, rtype]
+            if len(rows) >= config['chunk']:
+                flush()
+        flush(recorder.export() if recorder is not None else None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        results.close()
+
+
+class ShardedResolver:
+    '''
+    Resolves (url, rtype) pairs in worker processes, one per core by
+    default, each keeping concurrency queries in flight. resolve
+    yields the formatted output of every item, in the order of the
+    items with ordered set, else as soon as it is ready. Ordered, no
+    more than window items are sent out past the first one still
+    missing, so a slow answer holds the workers back rather than
+    leaving ever more output waiting in memory. rate is the
+    most new queries per second of all the workers together, and
+    server_rate the most queries per second to each server. With
+    adaptive set every worker adapts its window of queries in flight.
+    With cache_file the workers share the answers through that file.
+
+    Usage:
+        resolver = ShardedResolver(['1.1.1.1'], workers=8, rate=5000)
+        for text in resolver.resolve(read_batch(open('names.txt'))):
+            sys.stdout.write(text)
+    '''
+
+    def __init__(self, dns, port=53, workers=None, concurrency=100,
+                 timeout=5, recurse=False, tcp=False, bufsize=1232,
+                 cache_size=1024, race=False, rate=None, output='text',
+                 ordered=False, chunk=100, server_rate=None,
+                 adaptive=False, cache_file=None):
+        if isinstance(dns, ServerSelector):
+            dns = dns.servers
+        elif isinstance(dns, (str, bytes)):
+            dns = [dns]
+        if not workers:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.ordered = ordered
+        # Two chunks waiting per worker stay well within a pipe buffer
+        self.chunk = chunk
+        # Most items handed out past the first one not yet written, with
+        # ordered set, so that one slow answer cannot fill the memory
+        self.window = workers * chunk * 4
+        self.config = {'dns': [server if isinstance(server, str)
+                               else server[0] for server in dns],
+                       'port': port, 'race': race,
+                       'concurrency': concurrency, 'timeout': timeout,
+                       'recurse': recurse, 'tcp': tcp, 'bufsize': bufsize,
+                       'cache_size': cache_size, 'format': output,
+                       'chunk': chunk, 'adaptive': adaptive,
+                       'cache_file': cache_file,
+                       'stats': instrument.recorder is not None}
+        self.limiter = SharedTokenBucket(rate) if rate else None
+        self.server_limiters = {}
+        if server_rate:
+            self.server_limiters = {
+                resolve_server(server, port): SharedTokenBucket(server_rate)
+                for server in self.config['dns']}
+
+    def resolve(self, items):
+        items = iter(items)
+        processes, tasks, results = [], [], []
+        for _ in range(self.workers):
+            task_out, task_in = multiprocessing.Pipe(duplex=False)
+            result_out, result_in = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=work, args=(self.config, task_out, result_in,
+                                   self.limiter, self.server_limiters),
+                daemon=True)
+            process.start()
+            task_out.close()
+            result_in.close()
+            processes.append(process)
+            tasks.append(task_in)
+            results.append(result_out)
+
+        waiting = [0] * self.workers
+        live = {conn: index for index, conn in enumerate(results)}
+        exhausted = finished = False
+        ready = {}
+        next_seq = sent = 0
+
+        def feed(index):
+            '''
+            Tops the worker up to two chunks it has not taken yet, as
+            long as the items sent stay within the window
+            '''
+            nonlocal exhausted, sent
+            while waiting[index] < 2 and not exhausted:
+                if self.ordered and sent - next_seq >= self.window:
+                    return
+                chunk = [(sent + offset, url, rtype) for offset, (url, rtype)
+                         in enumerate(itertools.islice(items, self.chunk))]
+                sent += len(chunk)
+                if not chunk:
+                    exhausted = True
+                    for conn in tasks:
+                        try:
+                            conn.send_bytes(marshal.dumps(None))
+                        except OSError:
+                            pass
+                    return
+                tasks[index].send_bytes(marshal.dumps(chunk))
+                waiting[index] += 1
+
+        try:
+            for index in range(self.workers):
+                feed(index)
+
+            while live:
+                for conn in wait(list(live)):
+                    index = live[conn]
+                    try:
+                        credits, rows, stats = marshal.loads(
+                            conn.recv_bytes())
+                    except (EOFError, OSError):
+                        del live[conn]
+                        continue
+                    if stats is not None and instrument.recorder is not None:
+                        instrument.recorder.merge(stats)
+
+                    waiting[index] -= credits
+                    feed(index)
+                    if not self.ordered:
+                        for _, text in rows:
+                            yield text
+                        continue
+                    ready.update(rows)
+                    if next_seq not in ready:
+                        continue
+                    while next_seq in ready:
+                        yield ready.pop(next_seq)
+                        next_seq += 1
+                    # The window moved, the workers it held back get more
+                    for other in live.values():
+                        feed(other)
+
+            # Items of a worker that died are missing, the rest still go
+            for key in sorted(ready):
+                yield ready[key]
+            finished = True
+
+        finally:
+            for conn in tasks + results:
+                conn.close()
+            # Stopped early, the workers would wait for more names
+            for process in processes:
+                if not finished:
+                    process.terminate()
+                process.join()
+
+
+if __name__ == '__main__':
+    print('This is the file for the sharded batch engine, run dns.py instead')
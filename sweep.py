@@ -0,0 +1,36 @@
+import ipaddress
+from wire import WireParser
+
+'''
+Reverse lookups over whole address blocks. The addresses are made
+one at a time as the resolver asks for them, so a block of any size
+costs the same memory.
+'''
+
+
+def sweep_addresses(cidrs):
+    '''
+    Yields every address of the IPv4 and IPv6 blocks, eg:
+        ['10.0.0.0/24', '2001:db8::/120']
+    A block may also be a single address. Host bits that are set are
+    ignored, 10.0.0.7/24 is the same as 10.0.0.0/24.
+    '''
+    for cidr in cidrs:
+        cidr = cidr.strip()
+        if cidr == '':
+            continue
+        for address in ipaddress.ip_network(cidr, strict=False):
+            yield str(address)
+
+
+def ptr_names(data):
+    '''The names of the PTR records in the answer section'''
+    message = WireParser(data).parse()
+    if message.header.rcode != 0:
+        return []
+    return [record.rdata.name for record in message.answer
+            if record.rtype == 12]
+
+
+if __name__ == '__main__':
+    print('This is the file for the PTR sweep, run dns.py instead')
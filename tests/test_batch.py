@@ -0,0 +1,31 @@
+import errno
+import io
+import pytest
+from batch import BatchLineError, BatchResolver, read_batch
+
+
+def test_send_error_fails_only_its_items():
+    # Sending to the broadcast address without SO_BROADCAST is EACCES
+    resolver = BatchResolver('255.255.255.255', timeout=1)
+    items = [('a.bench', b'A'), ('a.bench', b'AAAA'), ('b.bench', b'MX')]
+    results = list(resolver.resolve(items))
+    assert sorted((url, rtype) for url, rtype, *_ in results) == \
+        sorted(items)
+    for _, _, _, data, server, rtt in results:
+        assert isinstance(data, OSError) and data.errno == errno.EACCES
+        assert server is None and rtt is None
+    assert not resolver.pending and not resolver.inflight
+
+
+def test_read_batch_rejects_unknown_rtype():
+    stream = io.StringIO('a.bench\n\n# comment\nb.bench mxx\n')
+    names = read_batch(stream, 'A', ['A', 'MX'])
+    assert next(names) == ('a.bench', 'A')
+    with pytest.raises(BatchLineError, match='line 4'):
+        next(names)
+
+
+def test_read_batch_accepts_known_rtype():
+    stream = io.StringIO('a.bench mx\nb.bench\n')
+    assert list(read_batch(stream, 'AAAA', ['AAAA', 'MX'])) == \
+        [('a.bench', 'MX'), ('b.bench', 'AAAA')]
@@ -0,0 +1,68 @@
+import time
+from cache import DnsCache
+from fakeserver import canned_response
+from query import DnsQueryBuilder
+from wire import parse_message
+
+
+def query(url, rtype, bufsize=0):
+    builder = DnsQueryBuilder(bufsize)
+    packet = builder.build_query_packet(url, rtype, True)
+    return builder, packet
+
+
+def test_hit_ttl_counts_down():
+    cache = DnsCache()
+    builder, packet = query('mx1.bench', 'MX')
+    data = canned_response(packet)
+    key = DnsCache.key(builder, packet)
+    cache.put(key, data, builder.length)
+
+    time.sleep(1.1)
+    hit = cache.get(key, 4321)
+    message = parse_message(hit)
+    assert message.header.identification == 4321
+    ttls = [record.ttl for record in message.answer]
+    assert len(ttls) == 5
+    assert all(ttl < 300 for ttl in ttls)
+    assert [record.rdata.exchange for record in message.answer] == \
+        [record.rdata.exchange for record in parse_message(data).answer]
+
+
+def test_hit_ttl_never_past_expiry():
+    cache = DnsCache(max_ttl=60)
+    builder, packet = query('a1.bench', 'A')
+    key = DnsCache.key(builder, packet)
+    cache.put(key, canned_response(packet), builder.length)
+
+    ttl = parse_message(cache.get(key, 1)).answer[0].ttl
+    assert ttl <= 60
+
+
+def test_hit_keeps_opt_flags():
+    cache = DnsCache()
+    builder, packet = query('a1.bench', 'A', bufsize=1232)
+    # The fake server leaves EDNS out, the OPT of the query stands in
+    data = canned_response(packet)
+    data = data[:10] + b'\x00\x01' + data[12:] + packet[builder.length:]
+    key = DnsCache.key(builder, packet)
+    cache.put(key, data, builder.length)
+
+    time.sleep(1.1)
+    hit = cache.get(key, 1)
+    assert hit[-11:] == data[-11:]
+    assert parse_message(hit).answer[0].ttl < 300
+
+
+def test_broken_additional_section_not_cached():
+    cache = DnsCache()
+    builder, packet = query('a1.bench', 'A')
+    data = bytearray(canned_response(packet))
+    # One more additional record than there is data for
+    data[11] = 1
+    data += b'\x05'
+    key = DnsCache.key(builder, packet)
+    cache.put(key, bytes(data), builder.length)
+
+    assert len(cache) == 0
+    assert cache.get(key, 1) is None
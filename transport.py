@@ -0,0 +1,178 @@
+import socket
+import struct
+import instrument
+from collections import deque
+from functools import lru_cache
+
+'''
+DNS over UDP and over TCP (RFC 1035 section 4.2, RFC 7766).
+UDP queries are sent from a pool of sockets bound to ephemeral ports
+picked by the kernel, and an answer is only accepted if it comes from
+the server address and port and carries the ID of the query.
+Over TCP every message is prefixed by its length as 2 bytes, so there
+is no size limit like the one of UDP. Connections are kept open and
+reused, and many queries can be written before the answers are read.
+'''
+
+length_struct = struct.Struct('!H')
+
+
+def is_truncated(data):
+    '''The TC flag of a response, set when it did not fit in a datagram'''
+    return len(data) >= 4 and (data[2] & 2) != 0
+
+
+@lru_cache(maxsize=64)
+def resolve_server(dns, port):
+    '''The (address, port) pair replies of the server come from'''
+    if isinstance(dns, bytes):
+        dns = dns.decode('utf-8')
+    return (socket.gethostbyname(dns), int(port))
+
+
+def frame(packet):
+    return length_struct.pack(len(packet)) + packet
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed by the server')
+        data += chunk
+
+    return bytes(data)
+
+
+class UdpSocketPool:
+    '''
+    Keeps up to size UDP sockets open between queries, so a query
+    does not pay for creating, binding and closing its socket. Every
+    socket is bound to port 0, so the kernel picks a random ephemeral
+    port and any number of lookups can run side by side on one host.
+    '''
+
+    def __init__(self, size=8):
+        self.size = size
+        self.idle = []
+
+    def acquire(self):
+        if self.idle:
+            return self.idle.pop()
+        recorder = instrument.recorder
+        if recorder is not None:
+            started = instrument.clock()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('', 0))
+        if recorder is not None:
+            recorder.timing('socket', instrument.clock() - started)
+        return sock
+
+    def release(self, sock):
+        if len(self.idle) < self.size:
+            self.idle.append(sock)
+        else:
+            sock.close()
+
+    def close(self):
+        for sock in self.idle:
+            sock.close()
+        self.idle.clear()
+
+
+class TcpConnection:
+    '''One persistent TCP connection to a server'''
+
+    def __init__(self, server, timeout=5):
+        self.server = server
+        recorder = instrument.recorder
+        if recorder is not None:
+            started = instrument.clock()
+        self.sock = socket.create_connection(server, timeout)
+        if recorder is not None:
+            recorder.timing('connect', instrument.clock() - started)
+
+    def send(self, packets):
+        self.sock.sendall(b''.join(frame(packet) for packet in packets))
+
+    def receive(self):
+        length = length_struct.unpack(recv_exactly(self.sock, 2))[0]
+        return recv_exactly(self.sock, length)
+
+    def exchange_many(self, packets):
+        '''
+        Pipelines the packets over the connection, all of them are
+        written at once and the answers are matched back by query ID,
+        since the server may answer them in any order.
+        Returns the answers in the order of the packets.
+        '''
+        pending = {}
+        for index, packet in enumerate(packets):
+            pending.setdefault(packet[:2], deque()).append(index)
+        self.send(packets)
+
+        answers = [None] * len(packets)
+        for _ in range(len(packets)):
+            data = self.receive()
+            indexes = pending.get(data[:2])
+            if indexes:
+                answers[indexes.popleft()] = data
+
+        return answers
+
+    def close(self):
+        self.sock.close()
+
+
+class TcpConnectionPool:
+    '''
+    Keeps up to size idle connections per server.
+    A connection that fails is dropped, and the exchange is tried once
+    more on a new connection as the server may have closed an idle one.
+    '''
+
+    def __init__(self, timeout=5, size=4):
+        self.timeout = timeout
+        self.size = size
+        self.idle = {}
+
+    def acquire(self, server):
+        connections = self.idle.get(server)
+        if connections:
+            return connections.pop(), True
+        return TcpConnection(server, self.timeout), False
+
+    def release(self, connection):
+        connections = self.idle.setdefault(connection.server, [])
+        if len(connections) < self.size:
+            connections.append(connection)
+        else:
+            connection.close()
+
+    def exchange(self, server, packet):
+        return self.exchange_many(server, [packet])[0]
+
+    def exchange_many(self, server, packets):
+        while True:
+            connection, reused = self.acquire(server)
+            try:
+                answers = connection.exchange_many(packets)
+            except (OSError, ConnectionError):
+                connection.close()
+                if reused:
+                    continue
+                raise
+
+            self.release(connection)
+            return answers
+
+    def close(self):
+        for connections in self.idle.values():
+            for connection in connections:
+                connection.close()
+        self.idle.clear()
+
+
+if __name__ == '__main__':
+    print('This is the file for the TCP transport, run dns.py instead')
@@ -0,0 +1,351 @@
+import socket
+import struct
+from collections import namedtuple
+from records import (Header, Question, ResourceRecord, A, AAAA, NS, CNAME,
+                     PTR, MX, SOA, TXT, OPT, Unknown)
+
+'''
+Offset based parser for DNS messages (RFC 1035 section 4).
+The message is walked over a memoryview, names are decoded with
+the full 14-bit compression pointers and every name decoded at an
+offset is remembered, so a suffix that is pointed to many times is
+only decoded once.
+'''
+
+header_struct = struct.Struct('!HHHHHH')
+question_struct = struct.Struct('!HH')
+record_struct = struct.Struct('!HHLH')
+soa_struct = struct.Struct('!LLLLL')
+
+Message = namedtuple('Message',
+                     'header questions answer authority additional')
+
+
+def unpack(layout, data, offset):
+    '''layout.unpack_from, raising ValueError if data is cut short'''
+    try:
+        return layout.unpack_from(data, offset)
+    except struct.error:
+        raise ValueError('Message ends in the middle of a field')
+
+
+def decode_header(data):
+    '''
+    The DNS Header has exactly 12 bytes, each equally divided into 2 bytes,
+    namely identification number, flags, number of queries, number of
+    responses, number of authoratative responses and number of additional
+    answers
+    '''
+    return Header(*unpack(header_struct, data, 0))
+
+
+def read_name(data, offset, names):
+    '''
+    Decodes the name starting at offset.
+    Returns the name (without the trailing dot, the root is '') and
+    the offset right after the name in the message. Every compression
+    pointer must point below all the offsets walked for the name so
+    far, so each one moves strictly backwards and a name cannot loop.
+    Names over 255 bytes and names running past the end of the
+    message raise ValueError.
+    names maps the offsets already decoded to (name, end offset, size
+    in bytes) and is filled in with every label start walked here.
+    '''
+    labels = []
+    run = []
+    walked = []
+    suffix = ''
+    size = 0
+    lowest = offset
+    end = None
+
+    try:
+        while True:
+            hit = names.get(offset)
+            if hit is not None:
+                suffix, hit_end, suffix_size = hit
+                walked.extend((start, index, before, hit_end)
+                              for start, index, before in run)
+                size += suffix_size
+                if end is None:
+                    end = hit_end
+                break
+
+            length = data[offset]
+            if length == 0:
+                walked.extend((start, index, before, offset + 1)
+                              for start, index, before in run)
+                size += 1
+                if end is None:
+                    end = offset + 1
+                break
+
+            if length >= 192:
+                pointer = ((length & 63) << 8) | data[offset + 1]
+                if pointer >= lowest:
+                    raise ValueError('Compression pointer does not point '
+                                     'back')
+                walked.extend((start, index, before, offset + 2)
+                              for start, index, before in run)
+                run = []
+                if end is None:
+                    end = offset + 2
+                offset = lowest = pointer
+                continue
+
+            if length > 63:
+                raise ValueError('Unknown label type {}'.format(length >> 6))
+            if offset + 1 + length > len(data):
+                raise ValueError('Name runs past the end of the message')
+
+            run.append((offset, len(labels), size))
+            labels.append(str(data[offset + 1:offset + 1 + length], 'utf-8',
+                              'backslashreplace'))
+            size += 1 + length
+            if size > 255:
+                raise ValueError('Name is longer than 255 bytes')
+            offset += 1 + length
+    except IndexError:
+        raise ValueError('Name runs past the end of the message')
+
+    if size > 255:
+        raise ValueError('Name is longer than 255 bytes')
+    if suffix:
+        labels.append(suffix)
+    for start, index, before, start_end in walked:
+        names[start] = ('.'.join(labels[index:]), start_end, size - before)
+
+    return '.'.join(labels), end
+
+
+def read_strings(data, offset, end):
+    '''Decodes the <character-string>s of a TXT record'''
+    strings = []
+    while offset < end:
+        length = data[offset]
+        strings.append(str(data[offset + 1:offset + 1 + length], 'utf-8',
+                           'backslashreplace'))
+        offset += 1 + length
+
+    return strings
+
+
+def skip_name(data, offset):
+    '''The offset right after the name, without decoding it'''
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length >= 192:
+            return offset + 2
+        offset += 1 + length
+
+
+def ttl_offsets(data):
+    '''
+    The offsets of the TTL fields of the records of the message, but
+    for OPT records, whose TTL field holds the EDNS flags
+    '''
+    header = decode_header(data)
+    offset = 12
+    for _ in range(header.num_queries):
+        offset = skip_name(data, offset) + 4
+    offsets = []
+    for _ in range(header.num_response + header.num_authority +
+                   header.num_additional):
+        offset = skip_name(data, offset)
+        rtype, _, _, rdlength = unpack(record_struct, data, offset)
+        if rtype != 41:
+            offsets.append(offset + 4)
+        offset += 10 + rdlength
+        if offset > len(data):
+            raise ValueError('Record data runs past the end of the message')
+
+    return offsets
+
+
+class Section:
+    '''
+    One of the answer, authority and additional sections.
+    The records are decoded lazily while the section is iterated and
+    kept for later iterations, so a caller that stops early never
+    decodes the rest. The start of a section is found by skipping over
+    the records of the section before it without decoding them.
+    '''
+
+    def __init__(self, parser, count, previous=None):
+        self.parser = parser
+        self.count = count
+        self.previous = previous
+        self.records = []
+        self.offset = None
+        self.end_offset = None
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count != 0
+
+    def __iter__(self):
+        index = 0
+        while index < self.count:
+            if index == len(self.records):
+                if self.offset is None:
+                    self.offset = self.start()
+                record, self.offset = self.parser.read_record(self.offset)
+                self.records.append(record)
+            yield self.records[index]
+            index += 1
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+    def start(self):
+        if self.previous is None:
+            return self.parser.question_end()
+        return self.previous.end()
+
+    def end(self):
+        '''The offset right after the last record of the section'''
+        if self.end_offset is None:
+            offset = self.offset
+            if offset is None:
+                offset = self.start()
+            for _ in range(self.count - len(self.records)):
+                offset = self.parser.skip_record(offset)
+            self.end_offset = offset
+
+        return self.end_offset
+
+
+class WireParser:
+    '''
+    Parses a DNS message over a memoryview.
+    The header and the questions are decoded right away, the records
+    section by section as they are iterated.
+    Record data is decoded for A, AAAA, NS, CNAME, PTR, MX, SOA and TXT,
+    any other type is kept as raw bytes.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        self.names = {}
+        self.header = None
+        self.questions = None
+        self.questions_end = None
+        self.message = None
+
+    def parse(self):
+        if self.message is None:
+            header = self.read_header()
+            questions = self.read_questions()
+            answer = Section(self, header.num_response)
+            authority = Section(self, header.num_authority, answer)
+            additional = Section(self, header.num_additional, authority)
+            self.message = Message(header, questions, answer, authority,
+                                   additional)
+
+        return self.message
+
+    def read_opt(self):
+        '''
+        The OPT record of the additional section, None if there is
+        none. The other records are skipped without being decoded.
+        '''
+        additional = self.parse().additional
+        offset = additional.start()
+        for _ in range(additional.count):
+            end = skip_name(self.view, offset)
+            if (self.view[end] << 8) | self.view[end + 1] == 41:
+                return self.read_record(offset)[0]
+            offset = self.skip_record(offset)
+
+        return None
+
+    def read_header(self):
+        if self.header is None:
+            self.header = decode_header(self.view)
+        return self.header
+
+    def read_questions(self):
+        if self.questions is None:
+            offset = 12
+            questions = []
+            for _ in range(self.read_header().num_queries):
+                name, offset = read_name(self.view, offset, self.names)
+                qtype, qclass = unpack(question_struct, self.view, offset)
+                offset += 4
+                questions.append(Question(name, qtype, qclass))
+            self.questions = questions
+            self.questions_end = offset
+
+        return self.questions
+
+    def question_end(self):
+        self.read_questions()
+        return self.questions_end
+
+    def read_record(self, offset):
+        '''Decodes the record at offset, returns it and its end'''
+        name, offset = read_name(self.view, offset, self.names)
+        rtype, rclass, ttl, rdlength = unpack(record_struct, self.view,
+                                              offset)
+        offset += 10
+        end = offset + rdlength
+        if end > len(self.view):
+            raise ValueError('Record data runs past the end of the message')
+        if rtype == 41:
+            rdata = OPT(rclass, ttl >> 24, (ttl >> 16) & 255,
+                        (ttl & 32768) != 0, self.view[offset:end])
+        else:
+            rdata = self.read_rdata(rtype, offset, end)
+        return ResourceRecord(name, rtype, rclass, ttl, rdata), end
+
+    def skip_record(self, offset):
+        offset = skip_name(self.view, offset)
+        rdlength = (self.view[offset + 8] << 8) | self.view[offset + 9]
+        end = offset + 10 + rdlength
+        if end > len(self.view):
+            raise ValueError('Record data runs past the end of the message')
+        return end
+
+    def read_rdata(self, rtype, offset, end):
+        view = self.view
+        if rtype == 1 and end - offset == 4:
+            return A('{}.{}.{}.{}'.format(*view[offset:end]))
+
+        elif rtype == 28 and end - offset == 16:
+            return AAAA(socket.inet_ntop(socket.AF_INET6, view[offset:end]))
+
+        elif rtype == 2:
+            return NS(read_name(view, offset, self.names)[0])
+
+        elif rtype == 5:
+            return CNAME(read_name(view, offset, self.names)[0])
+
+        elif rtype == 12:
+            return PTR(read_name(view, offset, self.names)[0])
+
+        elif rtype == 15:
+            preference = (view[offset] << 8) | view[offset + 1]
+            return MX(preference, read_name(view, offset + 2, self.names)[0])
+
+        elif rtype == 6:
+            mname, offset = read_name(view, offset, self.names)
+            rname, offset = read_name(view, offset, self.names)
+            return SOA(mname, rname, *unpack(soa_struct, view, offset))
+
+        elif rtype == 16:
+            return TXT(read_strings(view, offset, end))
+
+        return Unknown(rtype, view[offset:end])
+
+
+def parse_message(data):
+    return WireParser(data).parse()
+
+
+if __name__ == '__main__':
+    print('This is the file for the wire format parser, run dns.py instead')